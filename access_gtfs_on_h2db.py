@@ -12,11 +12,35 @@ DB名を mem:hoge とすることで、インメモリDBとして動くので何
 
 from pathlib import Path
 from datetime import datetime, date, timedelta
-import h2dbgtfs
+import gtfsbackend
 import gtfsrealtime
-import csv
-import copy
-        
+import feedcache
+import alertindex
+import alertinterval
+import resultstore
+import idset
+import changelog
+import logwriter
+import checkpoint
+import stagetrace
+import gtfsarchive
+import numpy as np
+import os
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, islice
+from operator import itemgetter
+
+# main の集計で参照する表 shapes, stop_times などの大きな表は読み込まない
+REPORT_TABLES = ['calendar', 'calendar_dates', 'feed_info', 'trips']
+# 減便の集計で読む GTFS-RT alert の項目
+NO_SERVICE_FIELDS = {'period', 'effect', 'trip_id'}
+# 大きな検索結果を fetchmany で読むときの1回の行数
+FETCH_SIZE = 10000
+
+# 集計は select_trips_by_date + reduce_trips_by_date で行う これは benchmark.py が従来の方法
+# (全行を辞書のリストにして reduce_to_key_set でまとめる) の時間を比べるためだけに残している
 def select_trip_ids(cursor, start,end):
     sql="""
     select
@@ -36,109 +60,74 @@ def select_trip_ids(cursor, start,end):
     cursor.execute(sql, {'start': start, 'end':end})
     for row in cursor.fetchall():
         date = row['date']
-        service_id = row['service_id'].strip()
-        trip_id = row['trip_id'].strip()
-        route_id = row['route_id'].strip()
+        service_id = row['service_id']
+        trip_id = row['trip_id']
+        route_id = row['route_id']
         return_list.append({"date": date, "service_id": service_id, "trip_id": trip_id, "route_id": route_id})
     return return_list
-        
-        
-def select_service_ids(cursor, start, end):
+
+# 実行済みのカーソルから batch_size 行ずつ fetchmany し、1行ずつ(タプルのまま)返す
+def iter_rows(cursor, batch_size=FETCH_SIZE):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+# universal_calendar と trips の join を1回だけ行い、日付, service_id, trip_id, route_id を返す
+# 行の順序は決めない (reduce_trips_by_date は日付ごとに辞書でまとめるので、order by で join 全体をソートさせない)
+# batch_size を指定すると、全行を fetchall せずに batch_size 行ずつ読むジェネレータを返す
+def select_trips_by_date(cursor, start, end, batch_size=None):
     sql="""
     select
-        date,
-        service_id
+        uc.date,
+        uc.service_id,
+        tr.trip_id,
+        tr.route_id
     from
-        universal_calendar
+        universal_calendar as uc
+        inner join trips as tr
+        on uc.service_id = tr.service_id
     where
-        date >= %(start)s and
-        date <= %(end)s
+        uc.date >= %(start)s and
+        uc.date <= %(end)s
     """
-    return_list = []
-    cursor.execute(sql, {'start': start, 'end':end})
-    for row in cursor.fetchall():
-        date = row['date']
-        service_id = row['service_id'].strip()
-        return_list.append({"date": date, "service_id": service_id})
-    return return_list
-        
-        
-def select_number_of_trips(cursor, start, end):
-    sql = """
-    select
-        date as date,
-        count(*) as count
-    from(
-        select
-            uc.*,
-            tr.trip_id
-        from
-            universal_calendar as uc
-            inner join trips as tr
-            on uc.service_id = tr.service_id
-        where
-            date >= %(start)s and
-            date <= %(end)s
-    )as src
-    group by 
-        date
-    order by
-        date
-    """
-    return_dict = {}
     cursor.execute(sql, {'start': start, 'end':end})
-    for row in cursor.fetchall():
-        date = row['date']
-        count = row['count']
-        return_dict[date] = {"count": count}
-    return return_dict
-
-
-def append_column(old_dict, new_dict, keyword, header, table):
-    old_dict.setdefault('header', {})
-    #最大のlistの値を求める
-    max_list_length = 0
-    for element in old_dict.values():
-        if table in element and len(element[table]) > max_list_length:
-            max_list_length = len(element[table])
-
-    old_dict['header'].setdefault(table, [])
-    old_dict['header'][table].append(header)
-
-    #key = '2020-05-01', content= data
-    for key, content in new_dict.items():
-        new_value = content[keyword]
-        if not key in old_dict:
-            old_dict[key] = {table: []}
-        if not table in old_dict[key]:
-            old_dict[key][table] = []
-        while len(old_dict[key][table]) < max_list_length:
-            old_dict[key][table].append("")
-        old_dict[key][table].append(new_value)
-
-    for element in old_dict.values():
-        while (table in element) and (len(element[table]) < max_list_length+1):
-            element[table].append("")
-    
-def finalize_column(dict, table, remove_others = False):
-    for key, content in dict.items():
-        if key == 'header':
-            if remove_others:
-                content[table] = ['final']
-            else:
-                content[table].append('final')
-        else:
-            value_list = content[table]
-            final_val = ""
-            for val in value_list:
-                if not ((val is None) or (type(val) is str and len(val) <= 0)):
-                    final_val = val
-            if remove_others:
-                content[table] = [final_val]
-            else:
-                value_list.append(final_val)
-    
-    
+    if batch_size is not None:
+        return iter_rows(cursor, batch_size)
+    return cursor.fetchall()
+
+# select_trips_by_date の行から、reduce_to_key_set の結果と日付ごとの trip数 を1回の走査で作る
+# trip数は join の行数
+# rows はジェネレータでもよく、chunk_size 行ずつ列にして番号の int32 配列にするので、行のタプルを全部はメモリに持たない
+# 日付ごとのビット列は、最後に日付順に並べた番号の配列から IdSet.from_ids でまとめて作る
+def reduce_trips_by_date(rows, tables, chunk_size=FETCH_SIZE):
+    keys = ['service_id', 'trip_id', 'route_id']
+    date_table = idset.InternTable()
+    chunks = {key: [] for key in ['date'] + keys}
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        # 列への分解は zip(*chunk) より itemgetter の方が速い
+        chunks['date'].append(date_table.intern_many(list(map(itemgetter(0), chunk))))
+        for column, key in enumerate(keys, 1):
+            chunks[key].append(tables[key].intern_many(list(map(itemgetter(column), chunk))))
+    if not chunks['date']:
+        return {}, {}
+
+    date_ids = np.concatenate(chunks['date'])
+    order = np.argsort(date_ids, kind='stable')
+    counts = np.bincount(date_ids, minlength=len(date_table))
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    ids = {key: np.concatenate(chunks[key])[order] for key in keys}
+    reduced = {
+        date: {key: idset.IdSet.from_ids(tables[key], ids[key][bounds[i]:bounds[i + 1]]) for key in keys}
+        for i, date in enumerate(date_table.values)
+    }
+    number_of_trips = {date: {'count': int(counts[i])} for i, date in enumerate(date_table.values)}
+    return reduced, number_of_trips
 
 # 渡された2つの dictionanry のkeyの値に関して、変更があった場合に古いものを保存しながら新しい値を保存する
 def merge_and_logging_ordered_dictionary(old_dict, new_dict, keyword, version):
@@ -177,84 +166,225 @@ def reduce_to_key_set(input_list, aggregate_key):
 
     return return_val
 
-def main():
+# 1つのGTFSをDBに読み込み、日付ごとの集計結果を返す
+# server_cursor=True なら検索結果をサーバ側カーソルで fetch_size 行ずつ受け取る (H2 では全行をクライアントに持たない)
+def summarize_feed(d, backend='h2', skip_missing=False, fetch_size=FETCH_SIZE, session=None, server_cursor=False):
+    print("======================================")
+    print("LOAD: {}".format(d.absolute()))
+    # セッションがあれば、プールの接続を使い回して読み込む
+    if session is not None:
+        with session.load_gtfs(d.absolute(), tables=REPORT_TABLES, skip_missing=skip_missing) as gtfs_info:
+            return summarize_gtfs(gtfs_info, session.open_stream_cursor(gtfs_info, server_cursor, fetch_size), fetch_size)
+
+    gtfs_backend = gtfsbackend.get_backend(backend)
+    # 並列実行時に同じ名前のインメモリDBを共有しないよう、プロセスIDを付ける
+    dbname = "{}_{}".format(gtfsarchive.feed_name(d), os.getpid())
+    with stagetrace.span('load_gtfs'):
+        gtfs_info = gtfs_backend.load_gtfs(dbname, d.absolute(), tables=REPORT_TABLES, skip_missing=skip_missing)
+    summary = summarize_gtfs(gtfs_info, gtfs_backend.stream_cursor(dbname, server_cursor, fetch_size), fetch_size)
+    gtfs_backend.close_gtfs(dbname)
+    return summary
+
+# 読み込み済みのGTFSから、日付ごとの trip / service_id / route_id の集合と trip数を求める
+def summarize_gtfs(gtfs_info, cursor, fetch_size=FETCH_SIZE):
+    # trip_id などはこのGTFS内で番号に置き換え、日付ごとの集合をビット列で持つ
+    id_tables = {key: idset.InternTable() for key in ('service_id', 'trip_id', 'route_id')}
+    query_start = time.perf_counter()
+    # 検索結果は fetchmany で読みながら集合にまとめるので、検索と集計は1つの span にする
+    with stagetrace.span('query_reduce') as s:
+        rows = select_trips_by_date(cursor, gtfs_info['start'], gtfs_info['end'], fetch_size)
+        reduced, number_of_trips = reduce_trips_by_date(rows, id_tables)
+        cursor.close()
+        row_count = sum(value['count'] for value in number_of_trips.values())
+        s.set(rows=row_count)
+    print("query: {} rows in {:.3f} sec".format(row_count, time.perf_counter() - query_start))
+
+    return {
+        'start': gtfs_info['start'], 'end': gtfs_info['end'], 'service_matrix': gtfs_info['service_matrix'],
+        'reduced': reduced, 'number_of_trips': number_of_trips
+    }
+
+# 1つのGTFSの日付ごとの集計結果を返す cache_dir を指定すると、内容が同じGTFSはキャッシュから読む
+# 並列実行時は別プロセスで動くので、結果はpickleできる値だけにする
+def process_feed(d, backend='h2', skip_missing=False, cache_dir=None, cache_max_bytes=feedcache.DEFAULT_MAX_BYTES, session=None,
+                 fetch_size=FETCH_SIZE, server_cursor=False):
+    gtfs_name = gtfsarchive.feed_name(d)
+    summary = None
+    with stagetrace.span('feed', feed=gtfs_name) as s:
+        if cache_dir is not None:
+            key = feedcache.feed_key(d)
+            summary = feedcache.load_feed(cache_dir, key)
+            if summary is not None:
+                print("CACHE HIT: {}".format(d.absolute()))
+        s.set(cache_hit=summary is not None)
+        if summary is None:
+            summary = summarize_feed(d, backend, skip_missing, fetch_size, session, server_cursor)
+            if cache_dir is not None:
+                feedcache.save_feed(cache_dir, key, summary, cache_max_bytes)
+
+    info_by_date = {}
+    date_t = summary['start']
+    while date_t <= summary['end']:
+        info_by_date[date_t] = {'gtfs_name': gtfs_name}
+        date_t = date_t + timedelta(days=1)
+
+    return {
+        'gtfs_name': gtfs_name, 'info_by_date': info_by_date, 'service_matrix': summary['service_matrix'],
+        'reduced': summary['reduced'], 'number_of_trips': summary['number_of_trips']
+    }
+
+# gtfs_dir の順に process_feed の結果を返す workers が2以上ならプロセスプールで並列に読み込む
+# session_size が1以上なら、その本数の接続のプール(GTFSSession)を使い回し、asyncio でスレッドから並行に読み込む
+def load_feeds(gtfs_dir, backend='h2', workers=1, skip_missing=False, cache_dir=None, cache_max_bytes=feedcache.DEFAULT_MAX_BYTES, session_size=0,
+               fetch_size=FETCH_SIZE, server_cursor=False):
+    if session_size > 0:
+        with gtfsbackend.GTFSSession(backend, session_size) as session:
+            feeds = asyncio.run(gtfsbackend.map_feeds_async(
+                session, gtfs_dir, process_feed, backend, skip_missing, cache_dir, cache_max_bytes, session, fetch_size, server_cursor
+            ))
+        yield from feeds
+    elif workers <= 1:
+        for d in gtfs_dir:
+            yield process_feed(d, backend, skip_missing, cache_dir, cache_max_bytes, None, fetch_size, server_cursor)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(
+                process_feed, gtfs_dir, repeat(backend), repeat(skip_missing), repeat(cache_dir), repeat(cache_max_bytes),
+                repeat(None), repeat(fetch_size), repeat(server_cursor)
+            )
+
+# from_time から to_time まで1日ごとに、その時刻のスナップショットで運休(NO_SERVICE)になっている trip_id の集合を
+# [(時刻, 集合)] で時刻順に返す スナップショットが無い時刻は含まない
+def collect_suspended_trips(alert_path, from_time, to_time, workers=1):
+    alert_index = alertindex.load_index(alert_path)
+    decode_cache = gtfsrealtime.AlertDecodeCache()
+    snapshots = list(alertindex.iter_snapshots(alert_index, from_time, to_time, timedelta(days=1)))
+    # 運休(NO_SERVICE)の期間と trip_id だけを読む 期間はエポック秒のまま比較する
+    feeds = gtfsrealtime.read_alert_files(
+        [file for _, file in snapshots], NO_SERVICE_FIELDS, {'NO_SERVICE'}, epoch_seconds=True,
+        workers=workers, cache=decode_cache
+    )
+    # スナップショットから運休の区間インデックスを作り、各日の運休 trip を1回の走査で求める
+    samples = [(int(next_time.timestamp()), alert) for (next_time, _), (file, alert) in zip(snapshots, feeds)]
+    with stagetrace.span('alert_interval', rows=len(samples)):
+        no_service_index = alertinterval.build_interval_index(samples, {'NO_SERVICE'})
+        suspended_by_time = alertinterval.query_range(no_service_index, [t for t, _ in samples], 'trip_id')
+    if workers <= 1: #並列時はワーカーごとのキャッシュを使う
+        print("decode cache: {}".format(decode_cache.stats()))
+    return [(next_time, suspended_by_time[int(next_time.timestamp())]) for next_time, _ in snapshots]
+
+# checkpoint_dir を指定すると途中結果を保存し、次回は新しいGTFSディレクトリと新しいスナップショットだけを処理する
+# (毎日の実行では to_time に現在時刻を渡す)
+# trace_path / trace_collapsed_path を指定すると、段階ごとの計測(stagetrace)を JSON / flame graph 用の形式で書き出す
+# trace_memory=True なら tracemalloc でメモリの増分も測る
+# fetch_size は検索結果を読む行数の単位 server_cursor=True ならサーバ側カーソルを使い、H2 の検索結果を全行クライアントに持たない
+def main(backend='h2', workers=1, skip_missing=False, cache_dir=None, cache_max_bytes=feedcache.DEFAULT_MAX_BYTES, changelog_path=None, output_format='csv', session_size=0,
+         checkpoint_dir=None, from_time=None, to_time=None, trace_path=None, trace_collapsed_path=None, trace_memory=False,
+         fetch_size=FETCH_SIZE, server_cursor=False):
+    if trace_path is not None or trace_collapsed_path is not None:
+        stagetrace.start(trace_memory)
 #    base_dir = "uncompressed"
     base_dir = "/Users/niya/Documents/oguchi/2020/gtfs/h2db/"
     uncompress_dir = "uncompressed"
-    gtfs_dir = [files for files in Path(base_dir + uncompress_dir).iterdir()]
-    gtfs_dir.sort()
+    # 展開したディレクトリの代わりに GTFS の zip ファイルをそのまま置いてもよい (展開せずに読む)
+    gtfs_dir = [files for files in Path(base_dir + uncompress_dir).iterdir() if gtfsarchive.is_feed(files)]
+    gtfs_dir.sort(key=gtfsarchive.feed_name)
 
     gtfs_names = []
-    gtfs_by_date = {}
+    gtfs_by_date = resultstore.ResultStore()
     gtfs_by_route = {}
+    change_log = None if changelog_path is None else changelog.open_log(changelog_path)
+
+    new_gtfs_dir = gtfs_dir
+    if checkpoint_dir is not None:
+        feeds_state = checkpoint.load_feeds_state(checkpoint_dir)
+        if feeds_state is not None:
+            processed = set(feeds_state['gtfs_names'])
+            new_gtfs_dir = [d for d in gtfs_dir if gtfsarchive.feed_name(d) not in processed]
+            # 処理済みのGTFSより前に並ぶものが追加されたときは、列の順序が変わるので全体を作り直す
+            if len(new_gtfs_dir) > 0 and len(feeds_state['gtfs_names']) > 0 and gtfsarchive.feed_name(new_gtfs_dir[0]) < feeds_state['gtfs_names'][-1]:
+                print("CHECKPOINT: {} is older than processed feeds, rebuilding".format(gtfsarchive.feed_name(new_gtfs_dir[0])))
+                new_gtfs_dir = gtfs_dir
+            else:
+                gtfs_names = feeds_state['gtfs_names']
+                gtfs_by_date = feeds_state['store']
+                print("CHECKPOINT: {} processed feeds, {} new feeds".format(len(gtfs_names), len(new_gtfs_dir)))
 
-    for d in gtfs_dir:
-        print("======================================")
-        print("LOAD: {}".format(d.absolute()))
-        gtfs_name = d.name
+    # 結果のマージは読み込みの順序によらず gtfs_dir の順に行うので、逐次実行と同じ結果になる
+    for feed in load_feeds(new_gtfs_dir, backend, workers, skip_missing, cache_dir, cache_max_bytes, session_size, fetch_size, server_cursor):
+        gtfs_name = feed['gtfs_name']
         gtfs_names.append(gtfs_name)
-        gtfs_info = h2dbgtfs.load_gtfs(gtfs_name, d.absolute())
-
-        info_by_date = {}
-        date_t = gtfs_info['start']
-        while date_t <= gtfs_info['end']:
-            info_by_date[date_t] = {'gtfs_name': gtfs_name}
-            date_t = date_t + timedelta(days=1)
-
-        #各日付での gtfsの名称
-        append_column(gtfs_by_date, info_by_date, 'gtfs_name', gtfs_name, 'gtfs_name')
-        #各日付での service_id
-        service_ids = select_trip_ids(gtfs_info['cursor'], gtfs_info['start'], gtfs_info['end'])
-        reduced = reduce_to_key_set(service_ids, 'date')
-        append_column(gtfs_by_date, reduced, 'service_id', gtfs_name, 'service_id')
-        #各日付での trip数
-        number_of_trips = select_number_of_trips(gtfs_info['cursor'], gtfs_info['start'], gtfs_info['end'])
-        append_column(gtfs_by_date, number_of_trips, 'count', gtfs_name, 'number_of_trips')
-
-        append_column(gtfs_by_date, reduced, 'trip_id', gtfs_name, 'trips')
-
-        h2dbgtfs.close_gtfs(gtfs_name)
-
-    finalize_column(gtfs_by_date, 'gtfs_name')
-    finalize_column(gtfs_by_date, 'service_id')    
-    finalize_column(gtfs_by_date, 'number_of_trips')
-    finalize_column(gtfs_by_date, 'trips', True) 
+        reduced = feed['reduced']
+
+        with stagetrace.span('append_column', feed=gtfs_name, rows=len(feed['info_by_date'])):
+            #各日付での gtfsの名称
+            gtfs_by_date.append_column(feed['info_by_date'], 'gtfs_name', gtfs_name, 'gtfs_name')
+            #各日付での service_id
+            gtfs_by_date.append_column(reduced, 'service_id', gtfs_name, 'service_id')
+            #各日付での trip数
+            gtfs_by_date.append_column(feed['number_of_trips'], 'count', gtfs_name, 'number_of_trips', np.int64)
+
+            gtfs_by_date.append_column(reduced, 'trip_id', gtfs_name, 'trips')
+
+        # 前の版との差分を変更ログに追記する (追記済みの版は飛ばす)
+        if change_log is not None:
+            change_log_dates = changelog.append_feed(change_log, gtfs_name, reduced, feed['number_of_trips'])
+            if change_log_dates is not None:
+                print("CHANGE LOG: {} dates changed in {}".format(len(change_log_dates), gtfs_name))
+
+    # 変更ログの最新の値は版ごとではなく、全部の版を追記したあとに1回だけ保存する
+    if change_log is not None:
+        changelog.save_state(change_log)
+
+    # finalize_column は列を書き換えるので、その前の状態を保存する
+    if checkpoint_dir is not None:
+        checkpoint.save_feeds_state(checkpoint_dir, gtfs_names, gtfs_by_date)
+
+    with stagetrace.span('finalize_column', rows=len(gtfs_by_date)):
+        gtfs_by_date.finalize_column('gtfs_name')
+        gtfs_by_date.finalize_column('service_id')    
+        gtfs_by_date.finalize_column('number_of_trips')
+        gtfs_by_date.finalize_column('trips', True) 
 
     #gtfs_realtimeから減便
 
-    from_time = datetime(2020, 3, 1, 3, 0, 0)
-    to_time   = datetime(2020, 8, 20, 3, 0, 0)
+    if from_time is None:
+        from_time = datetime(2020, 3, 1, 3, 0, 0)
+    if to_time is None:
+        to_time = datetime(2020, 8, 20, 3, 0, 0)
     alert_path = Path("alert")
 
-    next_time = from_time
-    while next_time <= to_time:
-        file_name = next_time.strftime("%Y-%m-%dT%H:%M:*.pb")
-        files = sorted(alert_path.glob(file_name))
-        if len(files) > 0:
-            file = files[0]
-            f = open(file, "rb")
-            content = f.read()
-            f.close()
-            alert = gtfsrealtime.read_gtfs_realtime_alert(content)
-
-            key = next_time.date()
-            value = gtfs_by_date[key]['trips'][-1] # 最終要素
-            renew_value = copy.copy(value)
-            print("----------{}------------".format(key))
-
-            for data in alert['alert']:
-                for period in data.period:
-                    if period.start <= next_time and period.end >= next_time:
-                        for entity in data.informed_entity:
-                            if data.effect == 'NO_SERVICE': #運休
-                                renew_value.discard(entity.trip_id)
-            print("From: {} to {}".format(len(value), len(renew_value)))
-            gtfs_by_date[key]['trips'].append(renew_value)
-            gtfs_by_date[key]['trips'].append(value - renew_value) #diff
-            gtfs_by_date[key]['trips'].append(len(value))
-            gtfs_by_date[key]['trips'].append(len(renew_value))
-
-        next_time = next_time + timedelta(days=1)
+    suspended = []
+    alert_from_time = from_time
+    if checkpoint_dir is not None:
+        alerts_state = checkpoint.load_alerts_state(checkpoint_dir)
+        if alerts_state is not None and alerts_state['from_time'] == from_time and alerts_state['last_time'] is not None:
+            suspended = alerts_state['suspended']
+            # 前回最後に処理した時刻の1日後から (時刻の刻みは from_time からの1日ごとのまま)
+            alert_from_time = alerts_state['last_time'] + timedelta(days=1)
+            print("CHECKPOINT: alerts processed until {}".format(alerts_state['last_time']))
+    with stagetrace.span('alerts') as s:
+        suspended += collect_suspended_trips(alert_path, alert_from_time, to_time, workers)
+        s.set(rows=len(suspended))
+    if checkpoint_dir is not None:
+        checkpoint.save_alerts_state(checkpoint_dir, suspended, from_time, suspended[-1][0] if suspended else None)
+
+    for next_time, suspended_trips in suspended:
+        if next_time > to_time:
+            break
+        key = next_time.date()
+        value = gtfs_by_date.final_value(key, 'trips') # 最終要素
+        print("----------{}------------".format(key))
+
+        renew_value = value - suspended_trips #運休を除く
+        print("From: {} to {}".format(len(value), len(renew_value)))
+        gtfs_by_date.append_values(
+            key, 'trips',
+            renew_value,
+            value - renew_value, #diff
+            len(value),
+            len(renew_value)
+        )
 
 
 
@@ -263,14 +393,16 @@ def main():
 #    for k, v in gtfs_by_date.items():
 #        print("{}: {}".format(str(type(k)), v))
 
-    logfile = Path(base_dir + "log.csv")
-    with open(logfile, 'w') as f:
-        writer = csv.writer(f)
-        for k, v in gtfs_by_date.items():
-            val = [k]
-            for key, data in v.items():
-                val += data
-            writer.writerow(val)
+    # 行は1行ずつ作って書き出す
+    logfile = Path(base_dir + logwriter.FORMATS[output_format])
+    with stagetrace.span('write_log', format=output_format) as s:
+        s.set(rows=logwriter.write_log(gtfs_by_date.rows(), logfile, output_format))
+
+    trace = stagetrace.stop()
+    if trace is not None and trace_path is not None:
+        stagetrace.write_json(trace, trace_path)
+    if trace is not None and trace_collapsed_path is not None:
+        stagetrace.write_collapsed(trace, trace_collapsed_path)
 
 
 
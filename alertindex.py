@@ -0,0 +1,116 @@
+"""
+GTFS-RT alert の .pb ファイルの時刻インデックス
+ファイル名は "2020-03-01T03:00:12...pb" のように ISO 形式の時刻で始まるので、
+ファイル名の文字列順 = 時刻順 となる ディレクトリを1回だけ読み、ソートしたファイル名のリストを
+bisect で引くことで、時刻ごとの glob + sorted をしなくて済むようにする
+
+スナップショットを tar / zip にまとめたもの (bundle) をディレクトリに置いてもよい
+bundle の中のスナップショットは展開せずに、gtfsarchive.BundleMember として返す
+
+インデックスは index_file (既定は alert ディレクトリと同じ階層の .<ディレクトリ名>.alert_index.json) に保存し、
+ディレクトリと bundle の mtime が変わっていなければ次回はディレクトリや bundle を読まずにそのまま使う
+(alert ディレクトリ内に保存すると、保存したことでディレクトリの mtime が変わり、次回も読み直すことになる)
+"""
+import bisect
+import json
+import os
+from pathlib import Path
+import gtfsarchive
+
+
+INDEX_FILE_NAME = ".{}.alert_index.json"
+SUFFIX = ".pb"
+
+def default_index_file(alert_path):
+    alert_path = Path(alert_path).absolute()
+    return Path(alert_path.parent, INDEX_FILE_NAME.format(alert_path.name))
+
+# names: スナップショットのファイル名をソートしたもの
+# members: names と同じ順に、bundle の中のものは [bundle のファイル名, メンバー名]、ディレクトリに直接あるものは None
+def load_index(alert_path, index_file=None):
+    alert_path = Path(alert_path)
+    if index_file is None:
+        index_file = default_index_file(alert_path)
+    dir_mtime = os.stat(alert_path).st_mtime_ns
+
+    # ディレクトリが変わっていなければ、保存済みのインデックスにある bundle だけを stat して確かめる
+    saved = None
+    try:
+        with open(index_file) as f:
+            saved = json.load(f)
+        if saved['mtime'] == dir_mtime:
+            bundles = {name: os.stat(Path(alert_path, name)).st_mtime_ns for name in saved['bundles']}
+            if saved['bundles'] == bundles:
+                return {'path': alert_path, 'names': saved['names'], 'members': saved['members']}
+    except (FileNotFoundError, ValueError, KeyError):
+        saved = None
+
+    # 保存済みのインデックスの bundle ごとの中身 名前と mtime が同じ bundle は開き直さずにこれを使う
+    # (tar.gz は一覧を取るだけで全体を展開することになるため)
+    saved_bundles = {}
+    saved_entries = {}
+    if saved is not None:
+        saved_bundles = saved.get('bundles', {})
+        for name, member in zip(saved.get('names', []), saved.get('members', [])):
+            if member is not None:
+                saved_entries.setdefault(member[0], []).append((name, member))
+
+    # ファイルが追加されているので一覧を取り直す (.pb ファイルごとの stat はしない 新しいか変わった bundle だけ中身を読む)
+    entries = []
+    bundles = {}
+    for entry in os.scandir(alert_path):
+        if entry.name.endswith(SUFFIX):
+            entries.append((entry.name, None))
+        elif gtfsarchive.is_bundle(entry.name) and entry.is_file():
+            bundles[entry.name] = entry.stat().st_mtime_ns
+    for bundle in sorted(bundles):
+        if saved_bundles.get(bundle) == bundles[bundle]:
+            entries.extend(saved_entries.get(bundle, []))
+        else:
+            entries.extend((name, [bundle, member]) for name, member in gtfsarchive.list_bundle(Path(alert_path, bundle), SUFFIX))
+    entries.sort(key=lambda entry: entry[0])
+    names = [name for name, _ in entries]
+    members = [member for _, member in entries]
+    try:
+        with open(index_file, 'w') as f:
+            json.dump({'mtime': dir_mtime, 'bundles': bundles, 'names': names, 'members': members}, f)
+    except OSError:
+        print("cannot write alert index: {}".format(index_file))
+    return {'path': alert_path, 'names': names, 'members': members}
+
+# i 番目のスナップショットのパス (bundle の中のものは gtfsarchive.BundleMember)
+def snapshot_at(index, i):
+    member = index['members'][i]
+    if member is None:
+        return Path(index['path'], index['names'][i])
+    return gtfsarchive.BundleMember(Path(index['path'], member[0]), member[1], index['names'][i])
+
+def time_key(t, timespec="%Y-%m-%dT%H:%M:%S"):
+    return t.strftime(timespec)
+
+# t 以降で最初のスナップショット
+def first_at_or_after(index, t):
+    names = index['names']
+    i = bisect.bisect_left(names, time_key(t))
+    if i < len(names):
+        return snapshot_at(index, i)
+    return None
+
+# t と同じ分(HH:MM)のスナップショットのうち最初のもの 無ければ None
+# glob(t.strftime("%Y-%m-%dT%H:%M:*.pb")) を sorted して先頭を取るのと同じ結果になる
+def first_in_minute(index, t):
+    names = index['names']
+    prefix = time_key(t, "%Y-%m-%dT%H:%M:")
+    i = bisect.bisect_left(names, prefix)
+    if i < len(names) and names[i].startswith(prefix):
+        return snapshot_at(index, i)
+    return None
+
+# from_time から to_time まで step ごとに、その分のスナップショットを (時刻, パス) で返す
+def iter_snapshots(index, from_time, to_time, step):
+    next_time = from_time
+    while next_time <= to_time:
+        file = first_in_minute(index, next_time)
+        if file is not None:
+            yield next_time, file
+        next_time = next_time + step
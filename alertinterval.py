@@ -0,0 +1,123 @@
+"""
+GTFS-RT alert の区間インデックス
+時刻順に読んだスナップショットから、alert ごとに「有効期間(active_period) かつ スナップショットに載っていた期間」の区間を作り、
+その区間に対象の trip_id / route_id / stop_id を結び付ける
+
+スナップショットに載っていた期間は、同じ内容(gtfsrealtime.alert_fingerprint)の alert が連続して載っていた
+最初と最後のスナップショットの時刻とする これにより、スナップショットの時刻 t で
+「t のスナップショットに載っていて、有効期間に t を含む alert」を数えるのと同じ結果を、
+日数 x alert数 x 期間数 x 対象数 のループをせずに、区間を1回なめるだけで求められる
+"""
+import bisect
+import heapq
+from collections import namedtuple
+import gtfsrealtime
+
+
+Interval = namedtuple('Interval', ['start', 'end', 'effect', 'trip_id', 'route_id', 'stop_id'])
+KEYS = ['trip_id', 'route_id', 'stop_id']
+
+def close_run(intervals, run_start, run_end, alert):
+    entities = alert.informed_entity or []
+    ids = {key: frozenset(getattr(entity, key) for entity in entities if getattr(entity, key) is not None) for key in KEYS}
+    for period in (alert.period or []):
+        start = max(period.start, run_start)
+        end   = min(period.end, run_end)
+        if start <= end:
+            intervals.append(Interval(start, end, alert.effect, ids['trip_id'], ids['route_id'], ids['stop_id']))
+
+# samples: (スナップショットの時刻, read_gtfs_realtime_alert の結果) を時刻順に並べたもの
+# 時刻は alert の期間と同じ型 (epoch_seconds=True で読んだならエポック秒) にする
+def build_interval_index(samples, effects=None):
+    intervals = []
+    open_runs = {} # fingerprint -> [最初に載っていた時刻, 最後に載っていた時刻, alert]
+    for t, feed in samples:
+        seen = set()
+        for alert in feed['alert']:
+            if effects is not None and alert.effect not in effects:
+                continue
+            fingerprint = gtfsrealtime.alert_fingerprint(alert)
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            if fingerprint in open_runs:
+                open_runs[fingerprint][1] = t
+            else:
+                open_runs[fingerprint] = [t, t, alert]
+        # このスナップショットから消えた alert の区間を閉じる
+        for fingerprint in [fp for fp in open_runs if fp not in seen]:
+            close_run(intervals, *open_runs.pop(fingerprint))
+    for run in open_runs.values():
+        close_run(intervals, *run)
+
+    intervals.sort(key=lambda interval: interval.start)
+    return {'starts': [interval.start for interval in intervals], 'intervals': intervals}
+
+# query_point 用の中心区間木 (centered interval tree) 区間の端点の中央値 center で分け、
+# center を含む区間は開始順・終了順の両方で節に持ち、center より左・右にある区間は子の木に入れる
+def build_tree(intervals):
+    if not intervals:
+        return None
+    points = sorted([interval.start for interval in intervals] + [interval.end for interval in intervals])
+    center = points[len(points) // 2]
+    left = [interval for interval in intervals if interval.end < center]
+    right = [interval for interval in intervals if interval.start > center]
+    here = [interval for interval in intervals if interval.start <= center <= interval.end]
+    by_start = sorted(here, key=lambda interval: interval.start)
+    by_end = sorted(here, key=lambda interval: interval.end)
+    return {
+        'center': center,
+        'by_start': by_start, 'starts': [interval.start for interval in by_start],
+        'by_end': by_end, 'ends': [interval.end for interval in by_end],
+        'left': build_tree(left), 'right': build_tree(right)
+    }
+
+# 時刻 t に有効な alert の対象(key)の集合
+# 木は最初に呼ばれたときに作って index に持つ (main のように query_range しか使わなければ作らない)
+# 時刻 t を含む区間だけをたどるので、区間の数 n に対して O(log n + 該当する区間の数)
+def query_point(index, t, key='trip_id', effects=None):
+    if 'tree' not in index:
+        index['tree'] = build_tree(index['intervals'])
+    result = set()
+    node = index['tree']
+    while node is not None:
+        if t < node['center']:
+            found = node['by_start'][:bisect.bisect_right(node['starts'], t)]
+            node = node['left']
+        elif t > node['center']:
+            found = node['by_end'][bisect.bisect_left(node['ends'], t):]
+            node = node['right']
+        else:
+            found = node['by_start']
+            node = None
+        for interval in found:
+            if effects is None or interval.effect in effects:
+                result.update(getattr(interval, key))
+    return result
+
+# 複数の時刻それぞれに有効な alert の対象(key)の集合を {時刻: set} で返す
+# 時刻をソートし、区間の開始順と終了順(ヒープ)を1回ずつなめる
+def query_range(index, times, key='trip_id', effects=None):
+    intervals = index['intervals']
+    active = {} # 対象 -> それを含む有効な区間の数
+    ending = []
+    i = 0
+    result = {}
+    for t in sorted(times):
+        while i < len(intervals) and intervals[i].start <= t:
+            interval = intervals[i]
+            i += 1
+            if interval.end < t or (effects is not None and interval.effect not in effects):
+                continue
+            for value in getattr(interval, key):
+                active[value] = active.get(value, 0) + 1
+            heapq.heappush(ending, (interval.end, i - 1))
+        while ending and ending[0][0] < t:
+            _, j = heapq.heappop(ending)
+            # 数が 0 になった対象は消し、active には今有効な対象だけを残す
+            for value in getattr(intervals[j], key):
+                active[value] -= 1
+                if active[value] == 0:
+                    del active[value]
+        result[t] = set(active)
+    return result
@@ -0,0 +1,263 @@
+"""
+処理段階ごとのベンチマーク
+synthgtfs で規模(tier)ごとに合成した GTFS と alert のスナップショットを作り、
+読み込み・集計・書き出しの各段階の時間と、tracemalloc のピークメモリを測って JSON に書き出す
+
+    python benchmark.py --tiers small medium --backend sqlite --output bench.json
+    python benchmark.py --tiers small --compare bench_old.json   (前回の結果との時間の比を表示する)
+
+backend は h2 (localhost:5435 の H2 サーバー) か sqlite (プロセス内のDB) 時間は repeat 回の中央値で比べる
+メモリは時間を測ったあとに tracemalloc を有効にしてもう1回実行して測る (tracemalloc の遅さが時間に入らないように)
+"""
+import argparse
+import csv
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from itertools import count
+from pathlib import Path
+import gtfsbackend
+import gtfscalendar
+import gtfsrealtime
+import alertindex
+import alertinterval
+import resultstore
+import logwriter
+import synthgtfs
+import access_gtfs_on_h2db
+import stoptimes
+import stagetrace
+
+
+BENCHMARK_VERSION = 1
+
+# versions 個の版の GTFS と、alert のスナップショットを作る
+TIERS = {
+    'small': {
+        'feed': {'services': 10, 'trips': 2000, 'stops': 200, 'stops_per_trip': 20, 'routes': 20, 'days': 60, 'exceptions': 20},
+        'versions': 3,
+        'alert': {'snapshots': 200, 'interval': timedelta(hours=1), 'alerts': 50, 'churn': 0.02}
+    },
+    'medium': {
+        'feed': {'services': 50, 'trips': 20000, 'stops': 2000, 'stops_per_trip': 30, 'routes': 200, 'days': 120, 'exceptions': 200},
+        'versions': 5,
+        'alert': {'snapshots': 2000, 'interval': timedelta(minutes=15), 'alerts': 200, 'churn': 0.01}
+    },
+    'large': {
+        'feed': {'services': 200, 'trips': 100000, 'stops': 10000, 'stops_per_trip': 40, 'routes': 1000, 'days': 365, 'exceptions': 1000},
+        'versions': 8,
+        'alert': {'snapshots': 10000, 'interval': timedelta(minutes=5), 'alerts': 500, 'churn': 0.005}
+    }
+}
+
+dbname_counter = count(1)
+
+# func は処理した行数などの件数を返す
+def measure(func, repeat=3, memory=True):
+    seconds = []
+    rows = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = func()
+        seconds.append(time.perf_counter() - start)
+    result = {
+        'seconds': seconds, 'median': statistics.median(seconds), 'min': min(seconds),
+        'rows': rows, 'peak_bytes': None, 'max_rss_kb': stagetrace.max_rss_kb()
+    }
+    if memory:
+        tracemalloc.start()
+        func()
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+def generate(work_dir, params, seed=0):
+    feeds = []
+    for version in range(params['versions']):
+        feeds.append(synthgtfs.write_gtfs_feed(
+            Path(work_dir, "uncompressed", "feed{:02d}".format(version)), version=version, seed=seed, **params['feed']
+        ))
+    alerts = synthgtfs.write_alert_archive(
+        Path(work_dir, "alert"), feeds[-1]['trip_ids'], feeds[-1]['route_ids'], seed=seed, **params['alert']
+    )
+    return feeds, alerts
+
+def read_csv_rows(path):
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    return rows[1:]
+
+def run_tier(work_dir, params, backend='sqlite', repeat=3, memory=True, log=print):
+    gtfs_backend = gtfsbackend.get_backend(backend)
+    feeds, alerts = generate(work_dir, params)
+    first = feeds[0]['path'].absolute()
+    stages = {}
+
+    def stage(name, func):
+        stages[name] = measure(func, repeat, memory)
+        log("  {:<24} {:>10.4f} sec  rows={}  peak={}".format(
+            name, stages[name]['median'], stages[name]['rows'], stages[name]['peak_bytes']))
+
+    # GTFS の読み込み (表の読み込み・カレンダーの展開・universal_calendar の作成を含む)
+    def load_gtfs():
+        dbname = "bench_{}".format(next(dbname_counter))
+        gtfs_info = gtfs_backend.load_gtfs(dbname, first, tables=access_gtfs_on_h2db.REPORT_TABLES)
+        gtfs_backend.close_gtfs(dbname)
+        return gtfscalendar.count_rows(gtfs_info['service_matrix'])
+    stage('load_gtfs', load_gtfs)
+
+    calendar_rows = read_csv_rows(first / "calendar.txt")
+    calendar_dates_rows = read_csv_rows(first / "calendar_dates.txt")
+    def service_matrix():
+        matrix = gtfscalendar.build_service_matrix(feeds[0]['start'], feeds[0]['end'], calendar_rows, calendar_dates_rows)
+        return gtfscalendar.count_rows(matrix)
+    stage('service_matrix', service_matrix)
+
+    dbname = "bench_{}".format(next(dbname_counter))
+    gtfs_info = gtfs_backend.load_gtfs(dbname, first, tables=access_gtfs_on_h2db.REPORT_TABLES)
+    def universal_calendar():
+        gtfs_info['cursor'].execute("drop table universal_calendar")
+        rows = gtfs_backend.create_universal_calendar(gtfs_info['service_matrix'], gtfs_info['cursor'])
+        gtfsbackend.create_indexes(gtfs_info['cursor'], ['universal_calendar'])
+        return rows
+    stage('universal_calendar', universal_calendar)
+
+    def query_reduce():
+        summary = access_gtfs_on_h2db.summarize_gtfs(gtfs_info, gtfs_backend.stream_cursor(dbname))
+        return sum(value['count'] for value in summary['number_of_trips'].values())
+    stage('query_reduce', query_reduce)
+
+    # 従来の select_trip_ids + reduce_to_key_set
+    trip_rows = access_gtfs_on_h2db.select_trip_ids(gtfs_info['cursor'], gtfs_info['start'], gtfs_info['end'])
+    gtfs_backend.close_gtfs(dbname)
+    def reduce_to_key_set():
+        access_gtfs_on_h2db.reduce_to_key_set(trip_rows, 'date')
+        return len(trip_rows)
+    stage('reduce_to_key_set', reduce_to_key_set)
+
+    processed = [access_gtfs_on_h2db.process_feed(feed['path'], backend) for feed in feeds]
+    def result_store():
+        store = resultstore.ResultStore()
+        for feed in processed:
+            store.append_column(feed['info_by_date'], 'gtfs_name', feed['gtfs_name'], 'gtfs_name')
+            store.append_column(feed['reduced'], 'service_id', feed['gtfs_name'], 'service_id')
+            store.append_column(feed['number_of_trips'], 'count', feed['gtfs_name'], 'number_of_trips')
+            store.append_column(feed['reduced'], 'trip_id', feed['gtfs_name'], 'trips')
+        for table in ('gtfs_name', 'service_id', 'number_of_trips'):
+            store.finalize_column(table)
+        store.finalize_column('trips', True)
+        return len(store)
+    stage('result_store', result_store)
+
+    def stop_times_departures():
+        frequency = stoptimes.count_departures(first)
+        return int(frequency['departures'].sum())
+    stage('stop_times_departures', stop_times_departures)
+
+    alert_paths = sorted(alerts['path'].glob("*" + alertindex.SUFFIX))
+    def alert_decode():
+        return sum(len(feed['alert']) for _, feed in gtfsrealtime.read_alert_files(alert_paths))
+    stage('alert_decode', alert_decode)
+
+    def alert_decode_no_service():
+        feeds = gtfsrealtime.read_alert_files(
+            alert_paths, access_gtfs_on_h2db.NO_SERVICE_FIELDS, {'NO_SERVICE'}, epoch_seconds=True
+        )
+        return sum(len(feed['alert']) for _, feed in feeds)
+    stage('alert_decode_no_service', alert_decode_no_service)
+
+    def suspended_trips():
+        suspended = access_gtfs_on_h2db.collect_suspended_trips(
+            alerts['path'], alerts['start'], alerts['end'], 1
+        )
+        return sum(len(trips) for _, trips in suspended)
+    stage('suspended_trips', suspended_trips)
+
+    samples = [
+        (int(datetime.fromisoformat(path.name[:19]).timestamp()), feed)
+        for path, feed in gtfsrealtime.read_alert_files(
+            alert_paths, access_gtfs_on_h2db.NO_SERVICE_FIELDS, {'NO_SERVICE'}, epoch_seconds=True
+        )
+    ]
+    def alert_interval():
+        index = alertinterval.build_interval_index(samples, {'NO_SERVICE'})
+        return sum(len(trips) for trips in alertinterval.query_range(index, [t for t, _ in samples], 'trip_id').values())
+    stage('alert_interval', alert_interval)
+
+    store = resultstore.ResultStore()
+    for feed in processed:
+        store.append_column(feed['reduced'], 'trip_id', feed['gtfs_name'], 'trips')
+    store.finalize_column('trips')
+    for output_format, file_name in logwriter.FORMATS.items():
+        def write_log():
+            return logwriter.write_log(store.rows(), Path(work_dir, file_name), output_format)
+        stage('write_' + output_format, write_log)
+
+    return {
+        'params': {
+            'feed': params['feed'], 'versions': params['versions'],
+            'alert': dict(params['alert'], interval=params['alert']['interval'].total_seconds()),
+            'stop_times': feeds[0]['stop_times']
+        },
+        'stages': stages
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(tiers, backend='sqlite', repeat=3, memory=True, work_dir=None):
+    result = {
+        'version': BENCHMARK_VERSION, 'created': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(), 'python': platform.python_version(), 'platform': platform.platform(),
+        'backend': backend, 'repeat': repeat, 'tiers': {}
+    }
+    for tier in tiers:
+        print("========== {} ==========".format(tier))
+        with tempfile.TemporaryDirectory(dir=work_dir) as tier_dir:
+            result['tiers'][tier] = run_tier(tier_dir, TIERS[tier], backend, repeat, memory)
+    return result
+
+# 前回の結果との比 (今回 / 前回) 1より大きければ遅くなっている
+def compare(old, new):
+    ratios = {}
+    for tier, tier_result in new['tiers'].items():
+        old_stages = old['tiers'].get(tier, {}).get('stages', {})
+        for name, stage in tier_result['stages'].items():
+            if name in old_stages and old_stages[name]['median'] > 0:
+                ratios[(tier, name)] = stage['median'] / old_stages[name]['median']
+    return ratios
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark each stage on synthetic GTFS / GTFS-RT data")
+    parser.add_argument("--tiers", nargs="+", default=['small'], choices=list(TIERS))
+    parser.add_argument("--backend", default='sqlite', choices=list(gtfsbackend.BACKENDS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action='store_true', help="do not measure tracemalloc peak")
+    parser.add_argument("--work-dir", default=None, help="where synthetic data is generated (default: system temp)")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="previous result JSON to compare with")
+    args = parser.parse_args()
+
+    result = run(args.tiers, args.backend, args.repeat, not args.no_memory, args.work_dir)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print("written: {}".format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for (tier, name), ratio in compare(old, result).items():
+            print("{:<8} {:<24} x{:.2f}".format(tier, name, ratio))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+GTFSの版(version)ごとの、日付ごとの変更履歴
+新しい版を追加するたびに、その版に含まれる日付について、それまでの最新の値との差分
+(trip_id の追加・削除、service_id の追加・削除、trip数の増減) を変更ログに追記する
+
+変更ログは gzip 圧縮した JSON Lines で、1行が1つの版の差分 追記のたびに gzip のメンバーを追加するので書き換えはしない
+    {"version": "...", "dates": {"2020-03-01": {"trips_added": [...], "trips_removed": [...],
+                                                "service_added": [...], "service_removed": [...], "count_delta": 3}}}
+最新の値は日付ごとに trip_id / service_id の idset.IdSet (ログ全体で共通の InternTable の番号のビット列) で持ち、
+次の版の差分は過去の版を読み直さずに求める 最新の値は save_state で <変更ログ>.state に pickle で保存する
+(版ごとではなく実行の最後に1回 保存より後に追記された版があれば open_log がログを再生して作り直す)
+「版 V の時点での日付 D の値」は変更ログを V まで再生して求める (GTFSの読み込みは不要)
+"""
+import gzip
+import json
+import os
+import pickle
+from datetime import date
+from pathlib import Path
+import idset
+
+
+def state_path(log_path):
+    return Path(str(log_path) + ".state")
+
+# tables を渡すと set の代わりに tables の InternTable の idset.IdSet にする
+def empty_value(tables=None):
+    if tables is None:
+        return {'trips': set(), 'service_id': set(), 'count': 0}
+    return {'trips': idset.IdSet(tables['trips']), 'service_id': idset.IdSet(tables['service_id']), 'count': 0}
+
+def new_tables():
+    return {'trips': idset.InternTable(), 'service_id': idset.InternTable()}
+
+def read_records(log_path):
+    if not Path(log_path).exists():
+        return
+    with gzip.open(log_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+# value の値は set でも IdSet でもよい (set は書き換え、IdSet は新しい IdSet に置き換わる)
+def apply_diff(value, diff):
+    value['trips'] -= set(diff['trips_removed'])
+    value['trips'] |= set(diff['trips_added'])
+    value['service_id'] -= set(diff['service_removed'])
+    value['service_id'] |= set(diff['service_added'])
+    value['count'] += diff['count_delta']
+
+def apply_record(state, record, tables=None):
+    for date_string, diff in record['dates'].items():
+        apply_diff(state.setdefault(date.fromisoformat(date_string), empty_value(tables)), diff)
+
+# 変更ログを開く 保存済みの最新値がログと食い違っていれば、ログを再生して作り直す
+def open_log(log_path):
+    log_path = Path(log_path)
+    log_size = log_path.stat().st_size if log_path.exists() else 0
+    try:
+        with open(state_path(log_path), 'rb') as f:
+            saved = pickle.load(f)
+        if saved['log_size'] == log_size:
+            return {'path': log_path, 'state': saved['state'], 'versions': saved['versions'], 'tables': saved['tables']}
+    except (FileNotFoundError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+
+    state = {}
+    versions = []
+    tables = new_tables()
+    for record in read_records(log_path):
+        apply_record(state, record, tables)
+        versions.append(record['version'])
+    return {'path': log_path, 'state': state, 'versions': versions, 'tables': tables}
+
+def save_state(log):
+    tmp_path = state_path(log['path']).with_suffix(".tmp")
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(
+            {'log_size': log['path'].stat().st_size if log['path'].exists() else 0,
+             'state': log['state'], 'versions': log['versions'], 'tables': log['tables']},
+            f, protocol=pickle.HIGHEST_PROTOCOL
+        )
+    os.replace(tmp_path, state_path(log['path']))
+
+# 新しい版の日付ごとの値 (reduce_to_key_set の結果と日付ごとの trip数) を、それまでの最新の値と比べてログに追記する
+# 手間はこの版の日付と trip の数に比例する 最新の値はメモリ上で更新するだけなので、最後に save_state を呼ぶ
+def append_feed(log, version, reduced, number_of_trips):
+    if version in log['versions']:
+        print("{} is already in the change log".format(version))
+        return None
+
+    tables = log['tables']
+    dates = {}
+    for key in sorted(reduced.keys() | number_of_trips.keys()):
+        old = log['state'].get(key) or empty_value(tables)
+        new = empty_value(tables)
+        if key in reduced:
+            new['trips'] = idset.IdSet.from_values(tables['trips'], reduced[key]['trip_id'])
+            new['service_id'] = idset.IdSet.from_values(tables['service_id'], reduced[key]['service_id'])
+        new['count'] = int(number_of_trips[key]['count']) if key in number_of_trips else 0
+        diff = {
+            'trips_added': sorted(new['trips'] - old['trips']),
+            'trips_removed': sorted(old['trips'] - new['trips']),
+            'service_added': sorted(new['service_id'] - old['service_id']),
+            'service_removed': sorted(old['service_id'] - new['service_id']),
+            'count_delta': new['count'] - old['count']
+        }
+        if any(diff.values()):
+            dates[key.isoformat()] = diff
+            log['state'][key] = new
+
+    record = {'version': version, 'dates': dates}
+    with gzip.open(log['path'], 'at', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+    log['versions'].append(version)
+    return dates
+
+# 版 version の時点での日付 key の値 version=None なら最新
+def value_as_of(log_path, key, version=None):
+    value = None
+    for record in read_records(log_path):
+        diff = record['dates'].get(key.isoformat())
+        if diff is not None:
+            if value is None:
+                value = empty_value()
+            apply_diff(value, diff)
+        if record['version'] == version:
+            break
+    return value
+
+# 日付 key の値が変わった版と、その版での値の一覧
+def history(log_path, key):
+    value = empty_value()
+    changes = []
+    for record in read_records(log_path):
+        diff = record['dates'].get(key.isoformat())
+        if diff is not None:
+            apply_diff(value, diff)
+            changes.append((record['version'], {'trips': set(value['trips']), 'service_id': set(value['service_id']), 'count': value['count']}))
+    return changes
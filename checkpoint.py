@@ -0,0 +1,53 @@
+"""
+main の途中結果の保存 (差分実行用)
+checkpoint_dir に次の2つを pickle で保存し、次回は新しいGTFSと新しいスナップショットだけを処理して結果に加える
+
+feeds.pkl:  処理済みのGTFS名のリストと、finalize_column する前の ResultStore
+alerts.pkl: スナップショットの時刻ごとの運休 trip_id の集合と、開始時刻(from_time)、最後に処理したスナップショットの時刻
+"""
+import os
+import pickle
+from pathlib import Path
+
+
+# 保存する内容の形式を変えたら上げる (形式の違う保存内容は使わずに全体を作り直す)
+CHECKPOINT_VERSION = 1
+FEEDS_FILE = "feeds.pkl"
+ALERTS_FILE = "alerts.pkl"
+
+def load(checkpoint_dir, file_name):
+    try:
+        with open(Path(checkpoint_dir, file_name), 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (pickle.UnpicklingError, EOFError, AttributeError) as e:
+        print("broken checkpoint {}: {}".format(file_name, e))
+        return None
+    if state.get('version') != CHECKPOINT_VERSION:
+        print("checkpoint {} has another version, rebuilding".format(file_name))
+        return None
+    return state
+
+def save(checkpoint_dir, file_name, state):
+    Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+    path = Path(checkpoint_dir, file_name)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(dict(state, version=CHECKPOINT_VERSION), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_feeds_state(checkpoint_dir):
+    return load(checkpoint_dir, FEEDS_FILE)
+
+# store は finalize_column する前のものを保存する
+def save_feeds_state(checkpoint_dir, gtfs_names, store):
+    save(checkpoint_dir, FEEDS_FILE, {'gtfs_names': gtfs_names, 'store': store})
+
+def load_alerts_state(checkpoint_dir):
+    return load(checkpoint_dir, ALERTS_FILE)
+
+# suspended: [(スナップショットの時刻, 運休 trip_id の集合)] を時刻順に
+# from_time が変わると時刻の刻みが変わるので、読み込むときに同じ from_time かを確かめる
+def save_alerts_state(checkpoint_dir, suspended, from_time, last_time):
+    save(checkpoint_dir, ALERTS_FILE, {'suspended': suspended, 'from_time': from_time, 'last_time': last_time})
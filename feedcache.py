@@ -0,0 +1,85 @@
+"""
+処理済みGTFSのキャッシュ
+GTFSディレクトリ内のファイルの内容のハッシュ(とCACHE_VERSION)をキーにして、
+process_feed の結果 (universal_calendar の行列、日付ごとの trip / service_id の集合、trip数) を
+pickle + zlib で cache_dir に保存する 過去のGTFSは変わらないので、ヒットすればDBへの読み込みを省略できる
+
+キャッシュの合計サイズが max_bytes を超えたら、最後に使われた時刻(mtime)が古いものから削除する
+"""
+import hashlib
+import os
+import pickle
+import zlib
+from pathlib import Path
+import gtfsarchive
+
+
+# 結果の形式や集計処理を変えたら上げる (古いキャッシュは使われなくなり、いずれ削除される)
+CACHE_VERSION = 2
+CACHE_SUFFIX = ".feed.z"
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+READ_CHUNK = 1024 * 1024
+
+# ディレクトリ内のファイル名と内容からキーを作る zip の GTFS は zip ファイルの内容から作る
+def feed_key(gtfs_dir):
+    digest = hashlib.sha256("version={}".format(CACHE_VERSION).encode())
+    files = [Path(gtfs_dir)] if gtfsarchive.is_zip_feed(gtfs_dir) else sorted(Path(gtfs_dir).iterdir())
+    for file in files:
+        if not file.is_file():
+            continue
+        digest.update(file.name.encode() + b"\0")
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+                digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def cache_path(cache_dir, key):
+    return Path(cache_dir, key + CACHE_SUFFIX)
+
+# キャッシュがあれば結果を、なければ None を返す
+def load_feed(cache_dir, key):
+    path = cache_path(cache_dir, key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        result = pickle.loads(zlib.decompress(data))
+    except (zlib.error, pickle.UnpicklingError, EOFError):
+        print("broken cache: {}".format(path))
+        return None
+    os.utime(path) #最後に使われた時刻として mtime を更新する
+    return result
+
+def save_feed(cache_dir, key, result, max_bytes=DEFAULT_MAX_BYTES):
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    path = cache_path(cache_dir, key)
+    # 並列実行中に書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = path.with_name("{}.{}.tmp".format(path.name, os.getpid()))
+    with open(tmp_path, "wb") as f:
+        f.write(zlib.compress(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)))
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_bytes)
+
+# 合計サイズが max_bytes 以下になるまで、古いキャッシュから削除する
+def evict(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    entries = []
+    for path in Path(cache_dir).glob("*" + CACHE_SUFFIX):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+            print("evict cache: {}".format(path))
+        except FileNotFoundError:
+            pass
+        total -= size
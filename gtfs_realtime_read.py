@@ -6,6 +6,7 @@ https://github.com/MobilityData/gtfs-realtime-bindings/blob/master/python/README
 
 """
 import gtfsrealtime
+import alertindex
 import datetime
 from pathlib import Path
 
@@ -17,27 +18,32 @@ from_time = datetime.datetime(2020, 3, 1, 0, 0, 0)
 to_time   = datetime.datetime(2020, 6, 7, 23, 59, 59)
 
 
-def scan_gtfs_rt_files(path, from_time, to_time, step):
-    next_time = from_time
+# 変化した alert を、追加・削除・変更に分けて表示する
+def print_alert_diff(diff):
+    print("added: {}, removed: {}, modified: {}".format(len(diff['added']), len(diff['removed']), len(diff['modified'])))
+    for alert in diff['added']:
+        print("+ [{}] {} {}".format(alert.id, alert.effect, alert.header_text))
+    for alert in diff['removed']:
+        print("- [{}] {} {}".format(alert.id, alert.effect, alert.header_text))
+    for old, new in diff['modified']:
+        print("* [{}] {} {} -> {} {}".format(new.id, old.effect, old.header_text, new.effect, new.header_text))
+
+def scan_gtfs_rt_files(path, from_time, to_time, step, workers=1):
     pre_alert = None
-    while next_time <= to_time:
-        file_name = next_time.strftime("%Y-%m-%dT%H:%M:*.pb")
-        files = sorted(alert_path.glob(file_name))
-        if len(files) > 0:
-            file = files[0]
-            f = open(file, "rb")
-            content = f.read()
-            f.close()
-            alert = gtfsrealtime.read_gtfs_realtime_alert(content)
-
-
-            if not gtfsrealtime.comp_alert(pre_alert, alert):
-                print("==========={}===================".format(next_time))                
-#                gtfsrealtime.print_alert(alert)
-                print(gtfsrealtime.comp_alert(pre_alert, alert))
-            pre_alert = alert
-
-        next_time = next_time + datetime.timedelta(hours=HOUR_STEP)
+    decode_cache = gtfsrealtime.AlertDecodeCache()
+    index = alertindex.load_index(path)
+    snapshots = list(alertindex.iter_snapshots(index, from_time, to_time, datetime.timedelta(hours=step)))
+    feeds = gtfsrealtime.read_alert_files([file for _, file in snapshots], workers=workers, cache=decode_cache)
+    for (next_time, _), (file, alert) in zip(snapshots, feeds):
+
+
+        if not gtfsrealtime.comp_alert(pre_alert, alert):
+            print("==========={}===================".format(next_time))                
+#            gtfsrealtime.print_alert(alert)
+            print_alert_diff(gtfsrealtime.diff_alerts(pre_alert, alert))
+        pre_alert = alert
+    if workers <= 1: #並列時はワーカーごとのキャッシュを使う
+        print("decode cache: {}".format(decode_cache.stats()))
 
 
 
@@ -0,0 +1,145 @@
+"""
+GTFS の zip ファイルと、GTFS-RT alert のスナップショットをまとめた tar / zip (bundle) を、展開せずに読む
+
+FeedSource: GTFS のディレクトリか zip ファイル どちらでも表(trips など)ごとにテキストとして開ける
+            zip の中でサブディレクトリに入っている GTFS も読める
+BundleMember: bundle の中の1つのスナップショット alertindex が返し、gtfsrealtime.read_alert_file で読める
+              tar.gz は前から順にしか速く読めないので、時刻順に読む (ランダムに読むなら無圧縮の tar か zip にする)
+"""
+import io
+import tarfile
+import zipfile
+from collections import namedtuple, OrderedDict
+from pathlib import Path
+
+
+GTFS_SUFFIX = ".txt"
+ZIP_SUFFIX = ".zip"
+BUNDLE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".zip")
+# 同時に開いておく bundle の数 (プロセスごと)
+OPEN_BUNDLES = 4
+
+def is_zip_feed(path):
+    path = Path(path)
+    return path.suffix.lower() == ZIP_SUFFIX and path.is_file()
+
+def is_feed(path):
+    return Path(path).is_dir() or is_zip_feed(path)
+
+# GTFS の名前 zip は拡張子を除いた名前にして、展開したディレクトリと同じ名前になるようにする
+def feed_name(path):
+    path = Path(path)
+    return path.stem if is_zip_feed(path) else path.name
+
+# zip の中の {表名: メンバー名} サブディレクトリに入っているものは一番浅いものを使う
+def zip_tables(archive):
+    members = {}
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        name = info.filename.rsplit("/", 1)[-1]
+        if not name.endswith(GTFS_SUFFIX):
+            continue
+        table = name[:-len(GTFS_SUFFIX)]
+        if table not in members or info.filename.count("/") < members[table].count("/"):
+            members[table] = info.filename
+    return members
+
+class FeedSource:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.archive = None
+        self.members = None
+        if is_zip_feed(self.path):
+            self.archive = zipfile.ZipFile(self.path)
+            self.members = zip_tables(self.archive)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_zip(self):
+        return self.archive is not None
+
+    # ディレクトリの GTFS のファイルのパス (zip のときは使わない)
+    def file_path(self, table):
+        return Path(self.path, table + GTFS_SUFFIX)
+
+    def exists(self, table):
+        if self.archive is not None:
+            return table in self.members
+        return self.file_path(table).exists()
+
+    def describe(self, table):
+        if self.archive is not None:
+            return "{}!{}".format(self.path, self.members.get(table, table + GTFS_SUFFIX))
+        return str(self.file_path(table))
+
+    # 表をテキストとして開く zip のメンバーは展開せずに読みながら decode する
+    def open(self, table):
+        if self.archive is not None:
+            if table not in self.members:
+                raise FileNotFoundError(self.describe(table))
+            return io.TextIOWrapper(self.archive.open(self.members[table]), encoding='utf-8-sig', newline='')
+        return open(self.file_path(table), newline='', encoding='utf-8-sig')
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+
+BundleMember = namedtuple('BundleMember', ['bundle', 'member', 'name'])
+
+def is_bundle(path):
+    return Path(path).name.lower().endswith(BUNDLE_SUFFIXES)
+
+def open_bundle_file(path):
+    if Path(path).suffix.lower() == ZIP_SUFFIX:
+        return zipfile.ZipFile(path)
+    return tarfile.open(path, 'r:*')
+
+# bundle の中の suffix で終わるメンバーを (ファイル名, メンバー名) で返す
+def list_bundle(path, suffix):
+    archive = open_bundle_file(path)
+    try:
+        if isinstance(archive, zipfile.ZipFile):
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+        else:
+            names = [member.name for member in archive if member.isfile()]
+    finally:
+        archive.close()
+    return [(name.rsplit("/", 1)[-1], name) for name in names if name.endswith(suffix)]
+
+# 開いた bundle を使い回す 古いものから閉じる
+open_bundles = OrderedDict()
+
+def bundle_of(path):
+    key = str(path)
+    archive = open_bundles.get(key)
+    if archive is None:
+        archive = open_bundle_file(path)
+        open_bundles[key] = archive
+        if len(open_bundles) > OPEN_BUNDLES:
+            open_bundles.popitem(last=False)[1].close()
+    else:
+        open_bundles.move_to_end(key)
+    return archive
+
+def read_member(member):
+    archive = bundle_of(member.bundle)
+    if isinstance(archive, zipfile.ZipFile):
+        return archive.read(member.member)
+    f = archive.extractfile(member.member)
+    if f is None:
+        raise FileNotFoundError("{}!{}".format(member.bundle, member.member))
+    with f:
+        return f.read()
+
+# スナップショットのファイル名 (ファイル名は時刻で始まるので、この順が時刻順)
+def snapshot_name(path):
+    if isinstance(path, BundleMember):
+        return path.name
+    return Path(path).name
@@ -0,0 +1,139 @@
+"""
+GTFSを読み込むDBの実装を切り替える
+どの実装も load_gtfs(dbname, base_dir) / close_gtfs(dbname) を持ち、
+load_gtfs が返す cursor には %(name)s 形式のSQLをそのまま渡せる
+
+h2:     h2dbgtfs (H2サーバにpsycopg2で接続する。事前にH2サーバの起動が必要)
+sqlite: sqlitegtfs (プロセス内のインメモリSQLite。サーバ不要)
+
+GTFSSession は接続を最大 size 本までプールし、GTFSごとに表を作り直して接続を使い回す
+(H2 なら GTFSごとの接続の確立が不要になる) 複数スレッドから同時に使ってよい
+map_feeds_async で、セッションの接続数まで GTFSごとの処理を asyncio で並行に実行できる
+"""
+import importlib
+import asyncio
+import itertools
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+
+BACKENDS = {
+    'h2': 'h2dbgtfs',
+    'sqlite': 'sqlitegtfs',
+}
+
+# 使わない実装の依存ライブラリ(psycopg2など)を読み込まないよう、選ばれたときにimportする
+def get_backend(name='h2'):
+    if name not in BACKENDS:
+        raise ValueError("unknown backend: {} (choose from {})".format(name, ", ".join(BACKENDS)))
+    return importlib.import_module(BACKENDS[name])
+
+GTFS_FILES = ['agency','calendar','calendar_dates','feed_info','routes','shapes','stop_times','stops','translations','trips']
+# load_gtfs 自体が期間と universal_calendar の計算に使う表
+CALENDAR_TABLES = ['calendar','calendar_dates','feed_info']
+
+# 読み込む表の一覧を決める tables=None なら全ファイル
+# calendar 系の表は常に含め、shapes, stop_times のような大きな表は指定されたときだけ読む
+def resolve_tables(tables=None):
+    if tables is None:
+        return list(GTFS_FILES)
+    return list(CALENDAR_TABLES) + [table for table in tables if table not in CALENDAR_TABLES]
+
+# 表ごとに作るインデックス (表名, インデックス名, 列)
+INDEXES = {
+    'trips': [('trips_service_id', 'service_id')],
+    'universal_calendar': [('universal_calendar_date_service_id', 'date, service_id')],
+}
+
+# 読み込んだ表のうち、INDEXES にあるものにインデックスを作る
+def create_indexes(cursor, tables):
+    for table in tables:
+        for index_name, columns in INDEXES.get(table, []):
+            cursor.execute("create index if not exists {} on {}({})".format(index_name, table, columns))
+
+
+session_counter = itertools.count(1)
+
+class GTFSSession:
+    def __init__(self, backend='h2', size=4):
+        self.backend = get_backend(backend)
+        self.size = size
+        # H2 では接続ごとに別のインメモリDBを使う
+        self.prefix = "session{}_{}".format(next(session_counter), os.getpid())
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.connections = []
+        # 接続の名前の番号 捨てた接続の番号を使い回すと、H2 で生きている接続と同じDBを共有してしまう
+        self.connection_numbers = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        connection = self.backend.connect("{}_{}".format(self.prefix, next(self.connection_numbers)))
+        self.connections.append(connection)
+        return connection
+
+    # 空いている接続を返す 無ければ size 本まで新しく作り、それ以上は返却されるまで待つ
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.connections) < self.size:
+                return self.connect()
+        connection = self.idle.get()
+        # 捨てられた接続の代わり (None) なら新しく作る
+        if connection is None:
+            with self.lock:
+                return self.connect()
+        return connection
+
+    # 表を削除して接続を返す 削除に失敗した接続は使い回せないので捨てる
+    # load_gtfs の finally から呼ばれるので、ここで例外にすると済んだ集計まで失われる 例外にせず表示だけする
+    def release(self, connection):
+        try:
+            self.backend.reset_connection(connection)
+        except Exception as e:
+            print("discard broken connection: {}".format(e))
+            with self.lock:
+                self.connections.remove(connection)
+            try:
+                connection.close()
+            except Exception:
+                pass
+            # 接続を待っているスレッドがあれば、代わりの接続を作らせる
+            self.idle.put(None)
+            return
+        self.idle.put(connection)
+
+    # with session.load_gtfs(base_dir) as gtfs_info: の形で使う 抜けると表を削除して接続を返す
+    @contextmanager
+    def load_gtfs(self, base_dir, batch_size=1000, tables=None, skip_missing=False):
+        connection = self.acquire()
+        try:
+            yield self.backend.load_gtfs_on(connection, base_dir, batch_size, tables, skip_missing)
+        finally:
+            self.release(connection)
+
+    def open_stream_cursor(self, gtfs_info, named=False, itersize=10000):
+        return self.backend.open_stream_cursor(gtfs_info['connection'], named, itersize)
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+# func(base_dir, *args) を gtfs_dirs のそれぞれについてスレッドで実行し、結果を gtfs_dirs の順に返す
+# 同時に実行するのはセッションの接続数まで (func の中で session.load_gtfs を使う)
+async def map_feeds_async(session, gtfs_dirs, func, *args):
+    semaphore = asyncio.Semaphore(session.size)
+
+    async def run(base_dir):
+        async with semaphore:
+            return await asyncio.to_thread(func, base_dir, *args)
+
+    return await asyncio.gather(*(run(base_dir) for base_dir in gtfs_dirs))
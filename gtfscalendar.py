@@ -0,0 +1,135 @@
+"""
+calendar.txt と calendar_dates.txt から、日付 x service_id の運行有無を表す行列を作る
+pip install numpy
+
+行列は matrix[日付のindex, service_idのindex] = True/False の形で持つ
+曜日ごと、期間ごとの判定は numpy でまとめて行い、service_id x 日付 の Python ループはしない
+"""
+import numpy as np
+from datetime import datetime, timedelta
+
+
+WEEKDAY_COLUMNS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+#GTFSデータが対応している期間を取得する
+def get_data_duration(cursor):
+    
+    sql = """
+    select
+        min(start_date) as min_start_date,
+        max(end_date) as max_end_date
+    from
+        calendar
+    """    
+    cursor.execute(sql)
+    results = cursor.fetchall()
+    for row in results:
+        min_start_date = row['min_start_date']
+        max_end_date = row['max_end_date']
+
+    sql = """
+    select
+        feed_start_date,
+        feed_end_date
+    from
+        feed_info
+    """
+    cursor.execute(sql)
+    results = cursor.fetchall()
+    for row in results: 
+        feed_start_date = row['feed_start_date']
+        feed_end_date = row['feed_end_date']
+
+#    print("{}, {}, {}, {}".format(min_start_date, max_end_date, feed_start_date, feed_end_date))        
+    return clip_duration(min_start_date, max_end_date, feed_start_date, feed_end_date)
+
+# 日付はすべて 'YYYYMMDD' の文字列
+def clip_duration(min_start_date, max_end_date, feed_start_date, feed_end_date):
+    # feed_info の start_date と calendar の start_date の遅い方を start_date に
+    # feed_info の end_date と calendar の end_date の早いを end_date に
+    start_date = feed_start_date if feed_start_date >= min_start_date else min_start_date
+    end_date   = feed_end_date if feed_end_date <= max_end_date else max_end_date
+    return {
+        "start_date": datetime.strptime(start_date, "%Y%m%d").date(), 
+        "end_date"  : datetime.strptime(end_date,   "%Y%m%d").date()
+    }
+
+# 'YYYYMMDD' の文字列の列を datetime64[D] の配列に変換する
+def parse_gtfs_dates(values):
+    values = [str(v).strip() for v in values]
+    return np.array(["{}-{}-{}".format(v[0:4], v[4:6], v[6:8]) for v in values], dtype='datetime64[D]')
+
+# datetime64[D] の配列から曜日(月曜=0)を求める 1970-01-01 は木曜(3)
+def weekday_of(dates):
+    return (dates.astype('int64') + 3) % 7
+
+def build_service_matrix(start_date, end_date, calendar_rows, calendar_dates_rows):
+    """
+    calendar_rows: (service_id, monday, ..., sunday, start_date, end_date) の並び
+    calendar_dates_rows: (service_id, date, exception_type) の並び
+    """
+    dates = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+    weekdays = weekday_of(dates)
+
+    service_ids = []
+    service_index = {}
+    def index_of(service_id):
+        if service_id not in service_index:
+            service_index[service_id] = len(service_ids)
+            service_ids.append(service_id)
+        return service_index[service_id]
+
+    calendar_rows = list(calendar_rows)
+    calendar_dates_rows = list(calendar_dates_rows)
+    row_index = np.array([index_of(str(row[0]).strip()) for row in calendar_rows], dtype=np.int64)
+    exception_index = np.array([index_of(str(row[0]).strip()) for row in calendar_dates_rows], dtype=np.int64)
+
+    matrix = np.zeros((len(dates), len(service_ids)), dtype=bool)
+
+    if len(calendar_rows) > 0:
+        # 曜日フラグ (service x 7) を日付の曜日で引いて service x 日付 にする
+        flags = np.array([[str(v).strip() == "1" for v in row[1:8]] for row in calendar_rows], dtype=bool)
+        starts = parse_gtfs_dates([row[8] for row in calendar_rows])
+        ends   = parse_gtfs_dates([row[9] for row in calendar_rows])
+        active = flags[:, weekdays] & (dates[None, :] >= starts[:, None]) & (dates[None, :] <= ends[:, None])
+        # 同じ service_id の行が複数あれば OR をとる
+        by_service = np.zeros((len(service_ids), len(dates)), dtype=bool)
+        np.logical_or.at(by_service, row_index, active)
+        matrix |= by_service.T
+
+    if len(calendar_dates_rows) > 0:
+        exception_dates = parse_gtfs_dates([row[1] for row in calendar_dates_rows])
+        exception_types = np.array([str(row[2]).strip() for row in calendar_dates_rows])
+        day_index = (exception_dates - dates[0]).astype('int64')
+        in_range = (day_index >= 0) & (day_index < len(dates))
+        for i in np.nonzero(~in_range)[0]:
+            print("{} in calendar_date is out of duration.".format(tuple(calendar_dates_rows[i])))
+        # 追加(1)を先に、削除(2)を後に適用する (order by date, exception_type と同じ結果)
+        added   = in_range & (exception_types == "1")
+        removed = in_range & (exception_types == "2")
+        matrix[day_index[added], exception_index[added]] = True
+        matrix[day_index[removed], exception_index[removed]] = False
+
+    return {'start': start_date, 'end': end_date, 'service_ids': service_ids, 'matrix': matrix}
+
+# DBの calendar, calendar_dates を読んで行列を作る
+# calendar_dates.txt が無いGTFSでは with_calendar_dates=False とする
+def load_service_matrix(cursor, start_date, end_date, with_calendar_dates=True):
+    cursor.execute("select service_id, {}, start_date, end_date from calendar".format(", ".join(WEEKDAY_COLUMNS)))
+    calendar_rows = cursor.fetchall()
+    calendar_dates_rows = []
+    if with_calendar_dates:
+        cursor.execute("select service_id, date, exception_type from calendar_dates")
+        calendar_dates_rows = cursor.fetchall()
+    return build_service_matrix(start_date, end_date, calendar_rows, calendar_dates_rows)
+
+# (date, service_id) を日付順に返す
+def iter_date_service(service_matrix):
+    service_ids = service_matrix['service_ids']
+    start_date = service_matrix['start']
+    day_index, service_index = np.nonzero(service_matrix['matrix'])
+    for d, s in zip(day_index.tolist(), service_index.tolist()):
+        yield start_date + timedelta(days=d), service_ids[s]
+
+def count_rows(service_matrix):
+    return int(service_matrix['matrix'].sum())
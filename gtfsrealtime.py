@@ -8,7 +8,14 @@ https://github.com/MobilityData/gtfs-realtime-bindings/blob/master/python/README
 
 from google.transit import gtfs_realtime_pb2
 import datetime
-from collections import namedtuple
+import hashlib
+from collections import namedtuple, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import mmap
+import os
+import stagetrace
+import gtfsarchive
 
 
 cause_dict ={}
@@ -20,57 +27,218 @@ for v in gtfs_realtime_pb2._ALERT_EFFECT.values:
     effect_dict[v.number] = v.name
 
 
-def read_gtfs_realtime_alert(data):
+Period = namedtuple('Period', ['start', 'end'])
+InformedEntity = namedtuple('InformedEntity', ['agency_id', 'route_id', 'route_type', 'trip_id', 'stop_id'])
+Alert = namedtuple('Alert',['period', 'informed_entity', 'cause', 'effect', 'url', 'header_text', 'description_text', 'id'])
+
+# fields で読み込む項目を絞る (Alert と InformedEntity の項目名 指定しなかった項目は None)
+#   例: fields={'period', 'effect', 'trip_id'}
+# effects で読み込む effect を絞る 例: effects={'NO_SERVICE'}
+# epoch_seconds=True なら時刻を datetime に変換せず、エポック秒の整数のままにする
+def read_gtfs_realtime_alert(data, fields=None, effects=None, epoch_seconds=False):
     feed = gtfs_realtime_pb2.FeedMessage()
     feed.ParseFromString(data)
 
+    if fields is None:
+        alert_fields  = set(Alert._fields)
+        entity_fields = set(InformedEntity._fields)
+    else:
+        fields = set(fields)
+        entity_fields = set(InformedEntity._fields) if 'informed_entity' in fields else fields & set(InformedEntity._fields)
+        alert_fields  = fields & set(Alert._fields)
+        if len(entity_fields) > 0:
+            alert_fields.add('informed_entity')
+    with_period      = 'period' in alert_fields
+    with_entity      = 'informed_entity' in alert_fields
+    with_agency_id   = 'agency_id' in entity_fields
+    with_route_id    = 'route_id' in entity_fields
+    with_route_type  = 'route_type' in entity_fields
+    with_trip_id     = 'trip_id' in entity_fields
+    with_stop_id     = 'stop_id' in entity_fields
+    with_cause       = 'cause' in alert_fields
+    with_url         = 'url' in alert_fields
+    with_header_text = 'header_text' in alert_fields
+    with_description_text = 'description_text' in alert_fields
+    convert_time = int if epoch_seconds else datetime.datetime.fromtimestamp
+
     gtfs_realtime_version = feed.header.gtfs_realtime_version
-    timestamp             = datetime.datetime.fromtimestamp(feed.header.timestamp)
+    timestamp             = convert_time(feed.header.timestamp)
     alerts = []
     for entity in feed.entity:
-        active_period = []
-        informed_entity = []
-        Period = namedtuple('Period', ['start', 'end'])
-        InformedEntity = namedtuple('InformedEntity', ['agency_id', 'route_id', 'route_type', 'trip_id', 'stop_id'])
-        Alert = namedtuple('Alert',['period', 'informed_entity', 'cause', 'effect', 'url', 'header_text', 'description_text'])
-
-        for period in entity.alert.active_period:
-            active_period.append(
-                Period(
-                    start = datetime.datetime.fromtimestamp(period.start), 
-                    end = datetime.datetime.fromtimestamp(period.end)
-                )
-            )
+        alert = entity.alert
+        effect = effect_dict[alert.effect]
+        if effects is not None and effect not in effects:
+            continue
+
+        active_period = None
+        if with_period:
+            active_period = [
+                Period(start = convert_time(period.start), end = convert_time(period.end))
+                for period in alert.active_period
+            ]
         #Entitiy Selector
-        for ientity in entity.alert.informed_entity:
-            informed_entity.append(
+        informed_entity = None
+        if with_entity:
+            informed_entity = [
                 InformedEntity(
-                    agency_id  = ientity.agency_id,
-                    route_id   = ientity.route_id,
-                    route_type = ientity.route_type,
-                    trip_id    = ientity.trip.trip_id,
-                    stop_id    = ientity.stop_id
+                    agency_id  = ientity.agency_id  if with_agency_id  else None,
+                    route_id   = ientity.route_id   if with_route_id   else None,
+                    route_type = ientity.route_type if with_route_type else None,
+                    trip_id    = ientity.trip.trip_id if with_trip_id  else None,
+                    stop_id    = ientity.stop_id    if with_stop_id    else None
                 )
-            )
-        cause  = entity.alert.cause
-        effect = entity.alert.effect
+                for ientity in alert.informed_entity
+            ]
 
-        url              = entity.alert.url.translation[0].text
-        header_text      = entity.alert.header_text.translation[0].text
-        description_text = entity.alert.description_text.translation[0].text
         alerts.append(
             Alert(
                 period           = active_period,
                 informed_entity  = informed_entity,
-                cause            = cause_dict[cause],
-                effect           = effect_dict[effect],
-                url              = url,
-                header_text      = header_text,
-                description_text = description_text
+                cause            = cause_dict[alert.cause] if with_cause else None,
+                effect           = effect if 'effect' in alert_fields else None,
+                url              = alert.url.translation[0].text if with_url else None,
+                header_text      = alert.header_text.translation[0].text if with_header_text else None,
+                description_text = alert.description_text.translation[0].text if with_description_text else None,
+                id               = entity.id if 'id' in alert_fields else None
             )
         )
     return {'version': gtfs_realtime_version, 'timestamp': timestamp, 'alert': alerts}
 
+# FeedMessage のバイト列を protobuf のワイヤ形式のまま走査する (ParseFromString しない)
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+# (field番号, wire type, タグの先頭位置, 値の先頭位置, 次のフィールドの位置) を返す
+def iter_fields(data, pos, end):
+    while pos < end:
+        tag_start = pos
+        tag, pos = read_varint(data, pos)
+        field, wire_type = tag >> 3, tag & 7
+        value_start = pos
+        if wire_type == 0:
+            _, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value_start = pos
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError("unsupported wire type {}".format(wire_type))
+        yield field, wire_type, tag_start, value_start, pos
+
+# FeedHeader の timestamp(3) を除いた内容のハッシュと、timestamp を返す
+# 連続するスナップショットは timestamp 以外同じことが多いので、このハッシュで同じ内容かを判定できる
+def payload_key(data):
+    data = memoryview(data)
+    digest = hashlib.blake2b(digest_size=16)
+    timestamp = 0
+    for field, wire_type, tag_start, value_start, end in iter_fields(data, 0, len(data)):
+        if field == 1 and wire_type == 2: #FeedHeader
+            for h_field, h_wire_type, h_tag_start, h_value_start, h_end in iter_fields(data, value_start, end):
+                if h_field == 3 and h_wire_type == 0: #timestamp
+                    timestamp, _ = read_varint(data, h_value_start)
+                else:
+                    digest.update(data[h_tag_start:h_end])
+        else:
+            digest.update(data[tag_start:end])
+    return digest.hexdigest(), timestamp
+
+# 内容が同じスナップショットは、前回 read_gtfs_realtime_alert した結果を使い回す
+# max_size 件まで LRU で保持し、hits / misses を数える
+class AlertDecodeCache:
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.decoded = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, data, fields=None, effects=None, epoch_seconds=False):
+        content_key, timestamp = payload_key(data)
+        key = (
+            content_key,
+            None if fields is None else frozenset(fields),
+            None if effects is None else frozenset(effects),
+            epoch_seconds
+        )
+        if key in self.decoded:
+            self.hits += 1
+            self.decoded.move_to_end(key)
+            feed = dict(self.decoded[key])
+            feed['timestamp'] = timestamp if epoch_seconds else datetime.datetime.fromtimestamp(timestamp)
+            return feed
+
+        self.misses += 1
+        if not isinstance(data, bytes):
+            data = bytes(data) #mmap などは ParseFromString に渡せないので、ここで初めてコピーする
+        feed = read_gtfs_realtime_alert(data, fields, effects, epoch_seconds)
+        self.decoded[key] = feed
+        if len(self.decoded) > self.max_size:
+            self.decoded.popitem(last=False)
+        return feed
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.decoded)}
+
+# ファイルを mmap で読み、cache があれば内容が同じスナップショットの decode を省略する
+# path が gtfsarchive.BundleMember なら tar / zip から展開せずに読む
+def read_alert_file(path, fields=None, effects=None, epoch_seconds=False, cache=None):
+    if isinstance(path, gtfsarchive.BundleMember):
+        data = gtfsarchive.read_member(path)
+        if cache is not None:
+            return cache.read(data, fields, effects, epoch_seconds)
+        return read_gtfs_realtime_alert(data, fields, effects, epoch_seconds)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return read_gtfs_realtime_alert(b"", fields, effects, epoch_seconds)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if cache is not None:
+                return cache.read(data, fields, effects, epoch_seconds)
+            return read_gtfs_realtime_alert(data[:], fields, effects, epoch_seconds)
+
+# プロセスプールの各ワーカーが持つキャッシュ
+worker_cache = None
+
+def read_alert_file_in_worker(path, fields, effects, epoch_seconds):
+    global worker_cache
+    if worker_cache is None:
+        worker_cache = AlertDecodeCache()
+    return read_alert_file(path, fields, effects, epoch_seconds, worker_cache)
+
+# スナップショットのファイルをまとめて decode し、(path, feed) をファイル名(=時刻)順に返す
+# workers が2以上ならプロセスプールで並列に decode する
+# chunk_size 件ずつ処理して返すので、全ファイル分の結果を一度にメモリに持たない
+def read_alert_files(paths, fields=None, effects=None, epoch_seconds=False, workers=1, chunk_size=256, cache=None):
+    paths = sorted(paths, key=gtfsarchive.snapshot_name)
+    if workers <= 1:
+        if cache is None:
+            cache = AlertDecodeCache()
+        for path in paths:
+            with stagetrace.span('alert_decode', file=path) as s:
+                feed = read_alert_file(path, fields, effects, epoch_seconds, cache)
+                s.set(rows=len(feed['alert']))
+            yield path, feed
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(paths), chunk_size):
+            chunk = paths[i:i + chunk_size]
+            feeds = executor.map(
+                read_alert_file_in_worker, chunk, repeat(fields), repeat(effects), repeat(epoch_seconds),
+                chunksize=max(1, len(chunk) // (workers * 4))
+            )
+            yield from zip(chunk, feeds)
+
 def print_alert(alert):
 #    print(alert['version'])
     print("timestamp: {}".format(alert['timestamp']))
@@ -87,48 +255,58 @@ def print_alert(alert):
         print(data.header_text)
         print(data.description_text)
 
-def comp_alert(a, b):
-    if a is None or b is None:
-        return False
+# alert の内容 (期間, 対象, cause, effect, テキスト) から、並び順によらない指紋を作る
+# entity の id は配信ごとに振り直されることがあるので含めない
+def alert_fingerprint(alert):
+    periods  = sorted((str(period.start), str(period.end)) for period in (alert.period or []))
+    entities = sorted(tuple(str(v) for v in entity) for entity in (alert.informed_entity or []))
+    canonical = repr((periods, entities, alert.cause, alert.effect, alert.url, alert.header_text, alert.description_text))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
 
-    # version, timestamp, alertの3つ timestampは比較しない
-    if not a['version']  == b['version']:
-        return False
-    
-    alertA = a['alert'] #AlertA
-    alertB = b['alert'] #AlertB
+# feed 全体の指紋 alert の並び順によらない 一度計算したら feed['digest'] に保存する
+def feed_digest(feed):
+    if 'digest' not in feed:
+        fingerprints = sorted(alert_fingerprint(alert) for alert in feed['alert'])
+        feed['digest'] = hashlib.blake2b(repr((feed['version'], fingerprints)).encode(), digest_size=16).hexdigest()
+    return feed['digest']
 
-    if not len(alertA) == len(alertB):
-        return False
+def alerts_by_fingerprint(feed):
+    groups = {}
+    if feed is not None:
+        for alert in feed['alert']:
+            groups.setdefault(alert_fingerprint(alert), []).append(alert)
+    return groups
+
+# 2つの feed の alert の差分
+# added: b にだけある alert, removed: a にだけある alert, modified: 同じ id で内容が変わった (aの alert, bの alert)
+# 同じ内容の alert が複数あるときは個数も比べる (feed_digest と同じく多重集合として比べる)
+def diff_alerts(a, b):
+    groups_a = alerts_by_fingerprint(a)
+    groups_b = alerts_by_fingerprint(b)
+    counts_a = Counter({fp: len(alerts) for fp, alerts in groups_a.items()})
+    counts_b = Counter({fp: len(alerts) for fp, alerts in groups_b.items()})
+    added   = [alert for fp, n in (counts_b - counts_a).items() for alert in groups_b[fp][-n:]]
+    removed = [alert for fp, n in (counts_a - counts_b).items() for alert in groups_a[fp][-n:]]
 
-    #本当はZIPするまえにsortして順序を揃えた方が良いかもしれないが、適切なsortキーがない
-    for entityA, entityB in zip(alertA, alertB):
-        if not len(entityA.period) == len(entityB.period):
-            return False
-        for periodA, periodB in zip(entityA.period, entityB.period):
-            if(not periodA.start == periodB.start or not periodA.end == periodB.end ):
-                return False
-        
-        if not len(entityA.informed_entity) == len(entityB.informed_entity):
-            return False
-        for informed_entityA, informed_entityB in zip(entityA.informed_entity, entityB.informed_entity):
-            if(
-                not informed_entityA.agency_id  == informed_entityB.agency_id  or
-                not informed_entityA.route_id   == informed_entityB.route_id   or
-                not informed_entityA.route_type == informed_entityB.route_type or
-                not informed_entityA.trip_id    == informed_entityB.trip_id    or
-                not informed_entityA.stop_id    == informed_entityB.stop_id
-            ):
-                return False
-        
-        if(
-            not entityA.cause            == entityB.cause or 
-            not entityA.effect           == entityB.effect or
-            not entityA.url              == entityB.url or 
-            not entityA.header_text      == entityB.header_text or
-            not entityA.description_text == entityB.description_text
-        ):
-            return False                
-
-    return True
+    removed_by_id = {}
+    for i, alert in enumerate(removed):
+        if alert.id:
+            removed_by_id.setdefault(alert.id, []).append(i)
+    modified = []
+    paired = set()
+    added_only = []
+    for alert in added:
+        if removed_by_id.get(alert.id):
+            i = removed_by_id[alert.id].pop(0)
+            paired.add(i)
+            modified.append((removed[i], alert))
+        else:
+            added_only.append(alert)
+    removed = [alert for i, alert in enumerate(removed) if i not in paired]
+    return {'added': added_only, 'removed': removed, 'modified': modified}
 
+# 2つの feed の alert が同じなら True (timestamp は比較しない alert の並び順は問わない)
+def comp_alert(a, b):
+    if a is None or b is None:
+        return False
+    return feed_digest(a) == feed_digest(b)
@@ -10,132 +10,146 @@ DB名を mem:hoge とすることで、インメモリDBとして動くので何
 import psycopg2 
 #import copy
 import psycopg2.extras
-from pathlib import Path
-from datetime import datetime, date, timedelta
+import psycopg2.extensions
+import time
+import itertools
+import csv
+import gtfscalendar
+import gtfsbackend
+import gtfsarchive
+import stagetrace
 
 
 db_connection_info = {}
+stream_counter = itertools.count(1)
 
-#GTFSデータが対応している期間を取得する
-def get_data_duration(cursor):
-    
-    sql = """
-    select
-        min(start_date) as min_start_date,
-        max(end_date) as max_end_date
-    from
-        calendar
-    """    
-    cursor.execute(sql)
-    results = cursor.fetchall()
-    for row in results:
-        min_start_date = row['min_start_date']
-        max_end_date = row['max_end_date']
-
-    sql = """
-    select
-        feed_start_date,
-        feed_end_date
-    from
-        feed_info
-    """
-    cursor.execute(sql)
-    results = cursor.fetchall()
-    for row in results: 
-        feed_start_date = row['feed_start_date']
-        feed_end_date = row['feed_end_date']
-
-#    print("{}, {}, {}, {}".format(min_start_date, max_end_date, feed_start_date, feed_end_date))        
-    # feed_info の start_date と calendar の start_date の遅い方を start_date に
-    # feed_info の end_date と calendar の end_date の早いを end_date に
-    start_date = feed_start_date if feed_start_date >= min_start_date else min_start_date
-    end_date   = feed_end_date if feed_end_date <= max_end_date else max_end_date
-    return {
-        "start_date": datetime.strptime(start_date, "%Y%m%d").date(), 
-        "end_date"  : datetime.strptime(end_date,   "%Y%m%d").date()
-    }
-    
-#順序あり辞書(dictionary)として、key: date, value 空のlist のオブジェクトを返す
-def expand_date(from_date, to_date):
-    next_date = from_date
-    return_dict = {}
-    while next_date <= to_date:
-        return_dict[next_date] = set()
-        next_date = next_date + timedelta(days=1) #1日加える
-
-    return return_dict
-
-# calendar.txt を読み、日付とservice_idのsetというデータ構造を作る
-def expand_service_id_in_calendar(date_dict, cursor):
-    sql = "select * from calendar"
-    date_map = {0: "monday",1:"tuesday",2:"wednesday",3:"thursday",4:"friday",5:"saturday",6:"sunday"}
-    cursor.execute(sql)
-    results = cursor.fetchall()
-
-    for row in results: 
-        service_id = row["service_id"]
-        start_date = datetime.strptime(row["start_date"], "%Y%m%d").date()
-        end_date   = datetime.strptime(row["end_date"], "%Y%m%d").date()
-
-        for date, service_set in date_dict.items():
-            state = row[date_map[date.weekday()]]
-            if state == "1" and date >= start_date and date <= end_date:
-                service_set.add(service_id)
-
-def process_exception_in_calendar_dates(date_dict, cursor):
-    sql = "select * from calendar_dates order by date, exception_type"
-    cursor.execute(sql)
-    results = cursor.fetchall()
-    for row in results: 
-        try:
-            date_info = date_dict[datetime.strptime(row["date"], "%Y%m%d").date()]
-            if row["exception_type"] == "1":
-                date_info.add(row["service_id"])
-            elif row["exception_type"] == "2":
-                date_info.remove(row["service_id"])
-        except KeyError:
-            print("{} in calendar_date is out of duration.".format(row))
-
-def create_universal_calendar(date_dict, cursor):
+# universal_calendar へのINSERTを1行ずつではなく、batch_size 行ごとの複数行VALUESでまとめて行う
+def create_universal_calendar(service_matrix, cursor, batch_size=1000):
     sql = """
     create table universal_calendar(
-        service_id char(255),
+        service_id varchar(255),
         date date
     )
     """
     cursor.execute(sql)
-    insert_sql = "insert into universal_calendar (service_id, date) values (%(service_id)s, %(date)s)"
-    for date, service_array in date_dict.items():
-        for service_id in service_array:
-    #        print("{}: {}".format(date, service_id))
-            cursor.execute(insert_sql, {"service_id": service_id, "date":date})
-
-
-def load_gtfs(dbname, base_dir):
+    insert_sql = "insert into universal_calendar (service_id, date) values %s"
+    rows = [(service_id, date) for date, service_id in gtfscalendar.iter_date_service(service_matrix)]
+
+    start_time = time.perf_counter()
+    with stagetrace.span('universal_calendar_insert', rows=len(rows)):
+        psycopg2.extras.execute_values(cursor, insert_sql, rows, page_size=batch_size)
+    elapsed = time.perf_counter() - start_time
+    rate = len(rows) / elapsed if elapsed > 0 else 0.0
+    print("universal_calendar: {} rows in {:.3f} sec ({:.0f} rows/sec)".format(len(rows), elapsed, rate))
+    return len(rows)
+
+
+# zip の中の表は CSVREAD で読めないので、展開しながら batch_size 行ずつ複数行VALUESでINSERTする
+# CSVREAD と同じく、列はすべて varchar、空の値は NULL にする
+def insert_csv_table(cursor, table, f, batch_size=1000):
+    reader = csv.reader(f)
+    header = [column.strip() for column in next(reader)]
+    cursor.execute("CREATE TABLE {} ({})".format(table, ", ".join("{} varchar".format(column) for column in header)))
+    insert_sql = "INSERT INTO {} ({}) VALUES %s".format(table, ", ".join(header))
+    # 末尾の空行などの空の行は飛ばす
+    reader = (row for row in reader if row)
+    count = 0
+    while True:
+        rows = [[value if value != "" else None for value in row] for row in itertools.islice(reader, batch_size)]
+        if not rows:
+            break
+        psycopg2.extras.execute_values(cursor, insert_sql, rows, page_size=batch_size)
+        count += len(rows)
+    return count
+
+# base_dir (GTFSのディレクトリか zip ファイル) の GTFSファイルを表として読み込み、読み込んだ表名のリストを返す
+# skip_missing=True なら存在しないファイルは飛ばす
+def load_tables(cursor, base_dir, tables, skip_missing=False, batch_size=1000):
+    loaded = []
+    with gtfsarchive.FeedSource(base_dir) as source:
+        for file in tables:
+            if skip_missing and not source.exists(file):
+                print("SKIP: {} does not exist".format(source.describe(file)))
+                continue
+            with stagetrace.span('csvread', table=file) as s:
+                if source.is_zip():
+                    with source.open(file) as f:
+                        s.set(rows=insert_csv_table(cursor, file, f, batch_size))
+                else:
+                    sql = "CREATE TABLE {} AS SELECT * FROM CSVREAD('{}')".format(file, str(source.file_path(file)))
+                    cursor.execute(sql)
+            loaded.append(file)
+    return loaded
+
+# H2 のインメモリDB mem:dbname に接続する
+def connect(dbname):
     #postgreSQLに接続（接続情報は環境変数、PG_XXX）
     connection = psycopg2.connect("dbname=mem:{} user=sa password='sa' host=localhost port=5435".format(dbname))
     #クライアントプログラムのエンコードを設定（DBの文字コードから自動変換してくれる）
     connection.set_client_encoding('utf-8') 
     #select結果を辞書形式で取得するように設定 
     connection.cursor_factory=psycopg2.extras.DictCursor
+    return connection
+
+# 接続済みのDBにGTFSを読み込む tables で必要な表だけを読み込む (None なら全ファイル)
+def load_gtfs_on(connection, base_dir, batch_size=1000, tables=None, skip_missing=False):
     #カーソルの取得
     cursor = connection.cursor()
 
-    gtfs_files = ['agency','calendar','calendar_dates','feed_info','routes','shapes','stop_times','stops','translations','trips']
+    loaded = load_tables(cursor, base_dir, gtfsbackend.resolve_tables(tables), skip_missing, batch_size)
 
-    for file in gtfs_files:
-        gtfs_file = Path(base_dir,file + ".txt")
-        sql = "CREATE TABLE {} AS SELECT * FROM CSVREAD('{}')".format(file, str(gtfs_file))
-        cursor.execute(sql)
-
-    duration = get_data_duration(cursor)
-    date_dict = expand_date(duration['start_date'], duration['end_date'])
-    expand_service_id_in_calendar(date_dict, cursor)
-    process_exception_in_calendar_dates(date_dict, cursor)
+    duration = gtfscalendar.get_data_duration(cursor)
+    with stagetrace.span('calendar_expand') as s:
+        service_matrix = gtfscalendar.load_service_matrix(cursor, duration['start_date'], duration['end_date'], 'calendar_dates' in loaded)
+        s.set(rows=gtfscalendar.count_rows(service_matrix))
+    create_universal_calendar(service_matrix, cursor, batch_size)
+    with stagetrace.span('create_indexes'):
+        gtfsbackend.create_indexes(cursor, loaded + ['universal_calendar'])
+    return {
+        'cursor':cursor, 'connection': connection, 'start': duration['start_date'], 'end':duration['end_date'],
+        'tables': loaded, 'service_matrix': service_matrix
+    }
 
-    create_universal_calendar(date_dict, cursor)
-    db_connection_info[dbname] = {'connection': connection, 'cursor': cursor}
-    return {'cursor':cursor, 'start': duration['start_date'], 'end':duration['end_date']}
+# 後から必要になった表は require_tables で読み込む
+def load_gtfs(dbname, base_dir, batch_size=1000, tables=None, skip_missing=False):
+    connection = connect(dbname)
+    gtfs_info = load_gtfs_on(connection, base_dir, batch_size, tables, skip_missing)
+    db_connection_info[dbname] = {
+        'connection': connection, 'cursor': gtfs_info['cursor'],
+        'base_dir': base_dir, 'tables': set(gtfs_info['tables']), 'skip_missing': skip_missing
+    }
+    return gtfs_info
+
+# まだ読み込んでいない表を、最初に必要になった時点で読み込む
+def require_tables(dbname, tables):
+    info = db_connection_info[dbname]
+    missing = [table for table in tables if table not in info['tables']]
+    loaded = load_tables(info['cursor'], info['base_dir'], missing, info['skip_missing'])
+    gtfsbackend.create_indexes(info['cursor'], loaded)
+    info['tables'].update(loaded)
+    return info['cursor']
+
+# 大きな検索結果を読むためのカーソル 行は辞書にせずタプルで返す
+# named=False (クライアント側カーソル) では execute の時点で全行が libpq に読み込まれるので、
+# fetchmany で減るのは Python のオブジェクトの分だけ
+# named=True ならサーバ側カーソル(名前付きカーソル)にして、結果を fetchmany / itersize の行数ずつ受け取る
+# (H2 の PostgreSQL互換モードが名前付きカーソルに対応していない場合は named=False のまま使う)
+def open_stream_cursor(connection, named=False, itersize=10000):
+    if not named:
+        return connection.cursor(cursor_factory=psycopg2.extensions.cursor)
+    cursor = connection.cursor(name="stream_{}".format(next(stream_counter)), cursor_factory=psycopg2.extensions.cursor)
+    cursor.itersize = itersize
+    return cursor
+
+def stream_cursor(dbname, named=False, itersize=10000):
+    return open_stream_cursor(db_connection_info[dbname]['connection'], named, itersize)
+
+# 接続を別のGTFSに使い回すため、表をすべて削除する
+def reset_connection(connection):
+    connection.rollback()
+    cursor = connection.cursor()
+    cursor.execute("DROP ALL OBJECTS")
+    cursor.close()
 
 #切断
 def close_gtfs(dbname):
@@ -0,0 +1,146 @@
+"""
+trip_id / service_id / route_id を GTFSごとに整数に置き換え(intern)、その集合をビット列で持つ
+IdSet は InternTable の番号をビット位置とする Python の int で、1要素あたり1ビットしか使わない
+和・差・積・要素数は int のビット演算と bit_count で求める
+
+同じ InternTable 同士なら演算はビット演算だけで済む 違う表の IdSet や、普通の set との演算は値(文字列)で行う
+str() は set の str() と同じ形式 ({'a', 'b'} / set()) で、値をソートして返す
+"""
+from itertools import compress, repeat
+import numpy as np
+
+
+class InternTable:
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def intern(self, value):
+        i = self.index.get(value)
+        if i is None:
+            i = len(self.values)
+            self.index[value] = i
+            self.values.append(value)
+        return i
+
+    def lookup(self, value):
+        return self.index.get(value)
+
+    # values をまとめて intern し、番号の int32 配列を返す
+    # 参照は map(dict.get) で C のループに任せ、表に無い値があったときだけ追加してから引き直す
+    def intern_many(self, values):
+        ids = np.array(list(map(self.index.get, values, repeat(-1))), dtype=np.int32)
+        missing = ids < 0
+        if missing.any():
+            for value in dict.fromkeys(compress(values, missing.tolist())):
+                self.intern(value)
+            ids = np.array(list(map(self.index.get, values)), dtype=np.int32)
+        return ids
+
+# ビット位置を bytearray に立てていき、最後に int にする (int に1ビットずつ OR すると毎回コピーが起きるため)
+class BitsBuilder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def add(self, i):
+        byte = i >> 3
+        if byte >= len(self.buffer):
+            self.buffer.extend(bytes(byte + 1 - len(self.buffer)))
+        self.buffer[byte] |= 1 << (i & 7)
+
+    def to_int(self):
+        return int.from_bytes(self.buffer, 'little')
+
+def iter_bits(bits):
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for byte_index, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield (byte_index << 3) + low.bit_length() - 1
+            byte ^= low
+
+class IdSet:
+    __slots__ = ('table', 'bits')
+
+    def __init__(self, table, bits=0):
+        self.table = table
+        self.bits = bits
+
+    @classmethod
+    def from_values(cls, table, values):
+        builder = BitsBuilder()
+        for value in values:
+            builder.add(table.intern(value))
+        return cls(table, builder.to_int())
+
+    # 番号の列 (array('i') や numpy 配列 重複してよい) から、ビット列を numpy でまとめて作る
+    @classmethod
+    def from_ids(cls, table, ids):
+        mask = np.zeros(len(table), dtype=bool)
+        mask[np.asarray(ids, dtype=np.int64)] = True
+        return cls(table, int.from_bytes(np.packbits(mask, bitorder='little').tobytes(), 'little'))
+
+    # 表に無い値は無視して、values のうち表にあるものだけのビット列を作る
+    def mask_of(self, values):
+        if isinstance(values, IdSet):
+            if values.table is self.table:
+                return values.bits
+            values = iter(values)
+        builder = BitsBuilder()
+        for value in values:
+            i = self.table.lookup(value)
+            if i is not None:
+                builder.add(i)
+        return builder.to_int()
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __iter__(self):
+        values = self.table.values
+        for i in iter_bits(self.bits):
+            yield values[i]
+
+    def __contains__(self, value):
+        i = self.table.lookup(value)
+        return i is not None and (self.bits >> i) & 1 == 1
+
+    def __sub__(self, other):
+        return IdSet(self.table, self.bits & ~self.mask_of(other))
+
+    def __and__(self, other):
+        return IdSet(self.table, self.bits & self.mask_of(other))
+
+    def __or__(self, other):
+        if isinstance(other, IdSet) and other.table is self.table:
+            return IdSet(self.table, self.bits | other.bits)
+        builder = BitsBuilder()
+        for value in other:
+            builder.add(self.table.intern(value))
+        return IdSet(self.table, self.bits | builder.to_int())
+
+    def __eq__(self, other):
+        if isinstance(other, IdSet) and other.table is self.table:
+            return self.bits == other.bits
+        if isinstance(other, (IdSet, set, frozenset)):
+            return set(self) == set(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(frozenset(self))
+
+    def to_set(self):
+        return set(self)
+
+    def __str__(self):
+        if not self.bits:
+            return "set()"
+        return "{" + ", ".join(repr(value) for value in sorted(self)) + "}"
+
+    __repr__ = __str__
@@ -0,0 +1,86 @@
+"""
+集計結果(ResultStore.rows() の行)をファイルに書き出す 行は1行ずつ受け取ってすぐ書くので、全行をメモリに持たない
+
+csv:   従来の log.csv と同じ形式 (集合は {'a', 'b'} の文字列)
+jsonl: gzip 圧縮した JSON Lines 集合の要素はファイル全体で共通の番号に置き換え、
+       ソートした番号の差分(delta)の列として書く 文字列と番号の対応は、初めて使う行の直前に書く
+    {"dict": ["trip_1", "trip_2"]}         ← 番号 0, 1 を追加
+    {"row": ["2020-03-01", "feedA", {"ids": [0, 1]}, 2]}
+read_jsonl で元の行 (集合は set) に戻せる
+"""
+import csv
+import gzip
+import json
+from datetime import date
+import idset
+
+
+FORMATS = {'csv': 'log.csv', 'jsonl': 'log.jsonl.gz'}
+
+def is_set(value):
+    return isinstance(value, (set, frozenset, idset.IdSet))
+
+def write_csv(rows, path):
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+def write_jsonl(rows, path):
+    string_ids = {}
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for row in rows:
+            new_strings = []
+            cells = []
+            for value in row:
+                if is_set(value):
+                    ids = []
+                    for element in value:
+                        element = str(element)
+                        if element not in string_ids:
+                            string_ids[element] = len(string_ids)
+                            new_strings.append(element)
+                        ids.append(string_ids[element])
+                    ids.sort()
+                    cells.append({'ids': [b - a for a, b in zip([0] + ids, ids)]})
+                elif isinstance(value, date):
+                    cells.append(value.isoformat())
+                else:
+                    cells.append(value if isinstance(value, (str, int, float)) or value is None else str(value))
+            if new_strings:
+                f.write(json.dumps({'dict': new_strings}, ensure_ascii=False, separators=(',', ':')) + "\n")
+            f.write(json.dumps({'row': cells}, ensure_ascii=False, separators=(',', ':')) + "\n")
+            count += 1
+    return count
+
+def read_jsonl(path):
+    strings = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'dict' in record:
+                strings.extend(record['dict'])
+                continue
+            row = []
+            for value in record['row']:
+                if isinstance(value, dict):
+                    elements = set()
+                    i = 0
+                    for delta in value['ids']:
+                        i += delta
+                        elements.add(strings[i])
+                    row.append(elements)
+                else:
+                    row.append(value)
+            yield row
+
+def write_log(rows, path, output_format='csv'):
+    if output_format == 'csv':
+        return write_csv(rows, path)
+    if output_format == 'jsonl':
+        return write_jsonl(rows, path)
+    raise ValueError("unknown output format: {} (choose from {})".format(output_format, ", ".join(FORMATS)))
@@ -0,0 +1,125 @@
+"""
+日付 x GTFS の集計結果を列ごとに保持する
+行(日付)は最初に現れた順に番号を振り、表(table)ごとにGTFS1つ分を1列として
+(行番号の配列, 値の配列) の形で追加する 既存の列の "" 埋めはしないので、列の追加は既存の行数によらない
+trip数などの数値の列は int64 の配列、trip_id の集合などはその参照を object 配列で持つ
+
+rows() で、従来の append_column / finalize_column の辞書を log.csv に書いたときと同じ行を返す
+    header, 表1のGTFS名..., final, 表2のGTFS名..., final, ...
+    日付,   表1の値...(無ければ ""), 表1の最終値, 表2の値..., 表2の最終値, (append_values で追加した値)...
+"""
+import numpy as np
+
+
+def is_empty(value):
+    return (value is None) or (type(value) is str and len(value) <= 0)
+
+def to_array(values, dtype):
+    if dtype is object:
+        # set や list を numpy に展開させないよう、要素ごとに代入する
+        array = np.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            array[i] = value
+        return array
+    return np.array(values, dtype=dtype)
+
+class ResultStore:
+    def __init__(self):
+        self.keys = []
+        self.key_index = {}
+        self.tables = {}
+        self.extra = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row_of(self, key):
+        row = self.key_index.get(key)
+        if row is None:
+            row = len(self.keys)
+            self.key_index[key] = row
+            self.keys.append(key)
+        return row
+
+    # new_dict: {日付: {keyword: 値}} の値を、表 table の新しい列 header として追加する
+    def append_column(self, new_dict, keyword, header, table, dtype=object):
+        values = [content[keyword] for content in new_dict.values()]
+        rows = np.fromiter((self.row_of(key) for key in new_dict), dtype=np.int64, count=len(new_dict))
+        valid = np.fromiter((not is_empty(value) for value in values), dtype=bool, count=len(values))
+        if dtype is not object and not valid.all():
+            dtype = object
+        info = self.tables.setdefault(table, {'headers': [], 'columns': [], 'final': None, 'remove_others': False})
+        info['headers'].append(header)
+        info['columns'].append({'rows': rows, 'values': to_array(values, dtype), 'valid': valid})
+
+    # 各日付で、空でない最後の値を最終値とする remove_others=True なら最終値だけを残す
+    def finalize_column(self, table, remove_others=False):
+        info = self.tables[table]
+        n = len(self.keys)
+        last_column   = np.full(n, -1, dtype=np.int64)
+        last_position = np.full(n, -1, dtype=np.int64)
+        present = np.zeros(n, dtype=bool)
+        for j, column in enumerate(info['columns']):
+            present[column['rows']] = True
+            positions = np.nonzero(column['valid'])[0]
+            last_column[column['rows'][positions]] = j
+            last_position[column['rows'][positions]] = positions
+
+        final = np.empty(n, dtype=object)
+        final[:] = ""
+        for j, column in enumerate(info['columns']):
+            selected = np.nonzero(last_column == j)[0]
+            final[selected] = column['values'][last_position[selected]]
+
+        info['final'] = final
+        info['present'] = present
+        info['remove_others'] = remove_others
+        if remove_others:
+            info['columns'] = []
+
+    def final_value(self, key, table):
+        return self.tables[table]['final'][self.key_index[key]]
+
+    # 最終値の後ろに値を追加する (運休を除いた trip の集合など)
+    def append_values(self, key, table, *values):
+        self.extra.setdefault((self.key_index[key], table), []).extend(values)
+
+    def header_row(self):
+        row = ['header']
+        for info in self.tables.values():
+            headers = [] if info['remove_others'] else list(info['headers'])
+            if info['final'] is not None:
+                headers.append('final')
+            row += headers
+        return row
+
+    def rows(self):
+        yield self.header_row()
+        n = len(self.keys)
+        tables = []
+        for table, info in self.tables.items():
+            positions = []
+            for column in info['columns']:
+                position = np.full(n, -1, dtype=np.int64)
+                position[column['rows']] = np.arange(len(column['rows']))
+                positions.append((position.tolist(), column['values'].tolist()))
+            present = info.get('present')
+            if present is None:
+                present = np.zeros(n, dtype=bool)
+                for column in info['columns']:
+                    present[column['rows']] = True
+            final = None if info['final'] is None else info['final'].tolist()
+            tables.append((table, positions, present.tolist(), final))
+
+        for row_number, key in enumerate(self.keys):
+            row = [key]
+            for table, positions, present, final in tables:
+                if not present[row_number]:
+                    continue
+                for position, values in positions:
+                    p = position[row_number]
+                    row.append(values[p] if p >= 0 else "")
+                if final is not None:
+                    row.append(final[row_number])
+                row += self.extra.get((row_number, table), [])
+            yield row
@@ -0,0 +1,164 @@
+"""
+h2dbgtfs と同じ load_gtfs / close_gtfs を、プロセス内の SQLite (インメモリDB) で提供する
+H2のサーバ起動やJVM、ソケット通信は不要
+
+SQLは h2dbgtfs (psycopg2) と同じ %(name)s 形式で書けるように、カーソルで :name 形式に変換する
+"""
+import sqlite3
+import csv
+import re
+import time
+from datetime import date
+import gtfscalendar
+import gtfsbackend
+import gtfsarchive
+import stagetrace
+
+
+db_connection_info = {}
+
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+sqlite3.register_converter("date", lambda b: date.fromisoformat(b.decode()))
+
+PYFORMAT_PATTERN = re.compile(r"%\((\w+)\)s")
+
+# psycopg2 と同じ %(name)s 形式のSQLを受け付けるカーソル
+class PyformatCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=None):
+        sql = PYFORMAT_PATTERN.sub(r":\1", sql)
+        if params is None:
+            return self.cursor.execute(sql)
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor.executemany(PYFORMAT_PATTERN.sub(r":\1", sql), seq_of_params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+# CSVREAD と同じく、ヘッダ行を列名、全列を文字列としてテーブルを作る
+# f: 表のテキスト (ディレクトリのファイルでも zip のメンバーでもよい)
+def load_csv_table(connection, table, f):
+    reader = csv.reader(f)
+    header = [column.strip() for column in next(reader)]
+    columns = ", ".join('"{}" text'.format(column) for column in header)
+    connection.execute('create table {} ({})'.format(table, columns))
+    placeholders = ", ".join("?" * len(header))
+    # 末尾の空行などの空の行は飛ばす
+    rows = (row for row in reader if row)
+    return connection.executemany('insert into {} values ({})'.format(table, placeholders), rows).rowcount
+
+def create_universal_calendar(service_matrix, cursor, batch_size=1000):
+    sql = """
+    create table universal_calendar(
+        service_id text,
+        date date
+    )
+    """
+    cursor.execute(sql)
+    insert_sql = "insert into universal_calendar (service_id, date) values (?, ?)"
+    rows = [(service_id, date) for date, service_id in gtfscalendar.iter_date_service(service_matrix)]
+
+    start_time = time.perf_counter()
+    with stagetrace.span('universal_calendar_insert', rows=len(rows)):
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(insert_sql, rows[i:i + batch_size])
+    elapsed = time.perf_counter() - start_time
+    rate = len(rows) / elapsed if elapsed > 0 else 0.0
+    print("universal_calendar: {} rows in {:.3f} sec ({:.0f} rows/sec)".format(len(rows), elapsed, rate))
+    return len(rows)
+
+
+# base_dir (GTFSのディレクトリか zip ファイル) の GTFSファイルを表として読み込み、読み込んだ表名のリストを返す
+# skip_missing=True なら存在しないファイルは飛ばす
+def load_tables(connection, base_dir, tables, skip_missing=False):
+    loaded = []
+    with gtfsarchive.FeedSource(base_dir) as source:
+        for file in tables:
+            if skip_missing and not source.exists(file):
+                print("SKIP: {} does not exist".format(source.describe(file)))
+                continue
+            with stagetrace.span('csvread', table=file) as s, source.open(file) as f:
+                s.set(rows=load_csv_table(connection, file, f))
+            loaded.append(file)
+    return loaded
+
+# プロセス内のインメモリDBを作る dbname は使わない (接続ごとに別のDBになる)
+# セッションで別スレッドから使えるよう check_same_thread=False にする (同時に使うのは1スレッドだけ)
+def connect(dbname=None):
+    connection = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    #select結果を列名でも取得できるようにする
+    connection.row_factory = sqlite3.Row
+    return connection
+
+# 接続済みのDBにGTFSを読み込む tables で必要な表だけを読み込む (None なら全ファイル)
+def load_gtfs_on(connection, base_dir, batch_size=1000, tables=None, skip_missing=False):
+    cursor = PyformatCursor(connection.cursor())
+
+    loaded = load_tables(connection, base_dir, gtfsbackend.resolve_tables(tables), skip_missing)
+
+    duration = gtfscalendar.get_data_duration(cursor)
+    with stagetrace.span('calendar_expand') as s:
+        service_matrix = gtfscalendar.load_service_matrix(cursor, duration['start_date'], duration['end_date'], 'calendar_dates' in loaded)
+        s.set(rows=gtfscalendar.count_rows(service_matrix))
+    create_universal_calendar(service_matrix, cursor, batch_size)
+    with stagetrace.span('create_indexes'):
+        gtfsbackend.create_indexes(cursor, loaded + ['universal_calendar'])
+    return {
+        'cursor':cursor, 'connection': connection, 'start': duration['start_date'], 'end':duration['end_date'],
+        'tables': loaded, 'service_matrix': service_matrix
+    }
+
+# 後から必要になった表は require_tables で読み込む
+def load_gtfs(dbname, base_dir, batch_size=1000, tables=None, skip_missing=False):
+    connection = connect(dbname)
+    gtfs_info = load_gtfs_on(connection, base_dir, batch_size, tables, skip_missing)
+    db_connection_info[dbname] = {
+        'connection': connection, 'cursor': gtfs_info['cursor'],
+        'base_dir': base_dir, 'tables': set(gtfs_info['tables']), 'skip_missing': skip_missing
+    }
+    return gtfs_info
+
+# まだ読み込んでいない表を、最初に必要になった時点で読み込む
+def require_tables(dbname, tables):
+    info = db_connection_info[dbname]
+    missing = [table for table in tables if table not in info['tables']]
+    loaded = load_tables(info['connection'], info['base_dir'], missing, info['skip_missing'])
+    gtfsbackend.create_indexes(info['cursor'], loaded)
+    info['tables'].update(loaded)
+    return info['cursor']
+
+# 大きな検索結果を読むためのカーソル 行は sqlite3.Row にせずタプルで返す
+# SQLite のカーソルは fetchmany で必要な分だけ結果を読むので、named / itersize は h2dbgtfs と同じ引数にするためだけにある
+def open_stream_cursor(connection, named=False, itersize=10000):
+    cursor = connection.cursor()
+    cursor.row_factory = None
+    return PyformatCursor(cursor)
+
+def stream_cursor(dbname, named=False, itersize=10000):
+    return open_stream_cursor(db_connection_info[dbname]['connection'], named, itersize)
+
+# 接続を別のGTFSに使い回すため、表をすべて削除する (インデックスも一緒に消える)
+def reset_connection(connection):
+    connection.rollback()
+    tables = [row[0] for row in connection.execute("select name from sqlite_master where type = 'table'")]
+    for table in tables:
+        connection.execute('drop table "{}"'.format(table))
+
+#切断
+def close_gtfs(dbname):
+    info = db_connection_info.pop(dbname) #delete
+    info['cursor'].close()
+    info['connection'].close()
@@ -0,0 +1,160 @@
+"""
+処理段階ごとの計測 (span)
+    with stagetrace.span('csvread', table='trips') as s:
+        ...
+        s.set(rows=n)
+で、その段階の経過時間・行数・最大RSSの増分を記録する start(memory=True) なら tracemalloc による
+メモリの増分とピーク(入れ子の span を含む)も記録する
+
+start() していないときの span() は何もしない共通のオブジェクトを返すだけなので、常に埋め込んだままにしておける
+記録した span は write_json で JSON に、write_collapsed で flame graph 用の collapsed stack 形式
+("main;load_feed;csvread 1234"、値は自分自身の時間のマイクロ秒) に書き出す
+
+span の親子関係はスレッドごとに持つ プロセスプールのワーカー内の span は記録されない
+"""
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+
+# 最大RSS (kB) ru_maxrss は Linux では kB、macOS ではバイトで返る
+def max_rss_kb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss // 1024
+    return max_rss
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Trace:
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.spans = []
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.origin = time.perf_counter()
+
+    def stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+class Span:
+    __slots__ = ('trace', 'record', 'start', 'rss', 'memory_start', 'memory_peak')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.record = {'name': name, 'attrs': attrs}
+
+    def __enter__(self):
+        trace = self.trace
+        stack = trace.stack()
+        parent = stack[-1] if stack else None
+        self.record['id'] = next(trace.ids)
+        self.record['parent'] = parent.record['id'] if parent is not None else None
+        self.record['path'] = (parent.record['path'] + ";" if parent is not None else "") + self.record['name']
+        self.record['thread'] = threading.current_thread().name
+        if trace.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent.memory_peak = max(parent.memory_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = current
+            self.memory_peak = current
+        stack.append(self)
+        self.rss = max_rss_kb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        trace = self.trace
+        stack = trace.stack()
+        stack.pop()
+        record = self.record
+        record['start'] = self.start - trace.origin
+        record['seconds'] = end - self.start
+        max_rss = max_rss_kb()
+        record['max_rss_kb'] = max_rss
+        record['max_rss_delta_kb'] = max_rss - self.rss
+        if trace.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self.memory_peak, peak)
+            record['memory_delta'] = current - self.memory_start
+            record['memory_peak_delta'] = peak - self.memory_start
+            if stack:
+                stack[-1].memory_peak = max(stack[-1].memory_peak, peak)
+            tracemalloc.reset_peak()
+        trace.spans.append(record)
+        return False
+
+    def set(self, **attrs):
+        self.record['attrs'].update(attrs)
+
+current_trace = None
+
+def span(name, **attrs):
+    if current_trace is None:
+        return NULL_SPAN
+    return Span(current_trace, name, attrs)
+
+# 計測を始める memory=True なら tracemalloc も動かす (その分遅くなる)
+def start(memory=False):
+    global current_trace
+    current_trace = Trace(memory)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return current_trace
+
+# 計測を止めて、記録した Trace を返す
+def stop():
+    global current_trace
+    trace = current_trace
+    current_trace = None
+    if trace is not None and trace.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return trace
+
+def write_json(trace, path):
+    spans = sorted(trace.spans, key=lambda record: record['start'])
+    with open(path, 'w') as f:
+        json.dump({'pid': os.getpid(), 'memory': trace.memory, 'spans': spans}, f, indent=1, default=str)
+    return len(spans)
+
+# 各 span の自分自身の時間 (子の span の時間を除く) を path ごとに合計する
+def self_times(trace):
+    child_seconds = defaultdict(float)
+    for record in trace.spans:
+        if record['parent'] is not None:
+            child_seconds[record['parent']] += record['seconds']
+    totals = defaultdict(float)
+    for record in trace.spans:
+        totals[record['path']] += max(0.0, record['seconds'] - child_seconds[record['id']])
+    return totals
+
+# flamegraph.pl / speedscope で読める collapsed stack 形式
+def write_collapsed(trace, path):
+    totals = self_times(trace)
+    with open(path, 'w') as f:
+        for stack_path, seconds in sorted(totals.items()):
+            f.write("{} {}\n".format(stack_path, int(seconds * 1000000)))
+    return len(totals)
@@ -0,0 +1,222 @@
+"""
+stop_times.txt を列ごとの numpy 配列にして、路線 x 時 x 日付 ごとの発車数(運行頻度)を求め、GTFSの版の間で比べる
+DBには読み込まず、GTFSのディレクトリか zip ファイル(gtfsarchive.FeedSource)から直接読む
+
+stop_times は chunk_size 行ずつ読み、1チャンクを
+    trip:      trip_id の番号 (trips.txt に無い trip_id は -1)
+    stop:      stop_id の番号 (stop_table を渡したときだけ 発車数の集計では使わないので読まない)
+    departure: 出発時刻の秒 (24:00 を超える時刻もそのまま 25:10:00 は 90600 時刻が空なら -1)
+の int32 配列にする 番号は idset.InternTable で振り、文字列の変換はチャンク内の異なる値ごとに1回だけ行う
+
+発車数は各 stop_times の行(出発時刻のあるもの)を1回と数え、時は出発時刻の時 (24以上もそのまま、運行日の日付で数える)
+チャンクごとに service x 路線 x 時 の件数を np.bincount で足し込み、最後に 日付 x service の行列
+(gtfscalendar.build_service_matrix) と掛けて 日付 x 路線 x 時 にする メモリはチャンクの大きさと結果の配列の分だけ使う
+"""
+import csv
+import itertools
+from datetime import timedelta
+from pathlib import Path
+import numpy as np
+import gtfsarchive
+import gtfscalendar
+import idset
+
+
+CHUNK_SIZE = 1000000
+
+def read_table(source, table):
+    with source.open(table) as f:
+        reader = csv.reader(f)
+        header = {column.strip(): i for i, column in enumerate(next(reader))}
+        yield header
+        # 末尾の空行などの空の行は飛ばす
+        yield from (row for row in reader if row)
+
+def column(rows, index):
+    return [row[index].strip() for row in rows]
+
+# GTFSの対象期間の service x 日付 の行列 (DBの get_data_duration + load_service_matrix と同じもの)
+def load_service_matrix(source):
+    calendar_rows = []
+    rows = read_table(source, 'calendar')
+    header = next(rows)
+    keys = ['service_id'] + gtfscalendar.WEEKDAY_COLUMNS + ['start_date', 'end_date']
+    for row in rows:
+        calendar_rows.append([row[header[key]] for key in keys])
+
+    rows = read_table(source, 'feed_info')
+    header = next(rows)
+    for row in rows:
+        feed_start_date = row[header['feed_start_date']]
+        feed_end_date = row[header['feed_end_date']]
+    duration = gtfscalendar.clip_duration(
+        min(row[8] for row in calendar_rows), max(row[9] for row in calendar_rows), feed_start_date, feed_end_date
+    )
+
+    calendar_dates_rows = []
+    if source.exists('calendar_dates'):
+        rows = read_table(source, 'calendar_dates')
+        header = next(rows)
+        calendar_dates_rows = [[row[header[key]] for key in ('service_id', 'date', 'exception_type')] for row in rows]
+    return gtfscalendar.build_service_matrix(duration['start_date'], duration['end_date'], calendar_rows, calendar_dates_rows)
+
+# 'H:MM:SS' / 'HH:MM:SS' / 'HHH:MM:SS' ... の文字列の列を秒の int32 配列にする 空なら -1
+# 時の桁数はチャンク内で一番長い値に合わせる 形式の違う値があれば ValueError
+def parse_times(values):
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int32)
+    times = np.array(values, dtype=bytes)
+    width = max(8, times.dtype.itemsize)
+    empty = np.char.str_len(times) == 0
+    chars = np.char.rjust(times, width, b'0').view(np.uint8).reshape(-1, width)
+    digits = chars.astype(np.int64) - ord('0')
+    digit_columns = list(range(width - 6)) + [width - 5, width - 4, width - 2, width - 1]
+    valid = (
+        (chars[:, width - 6] == ord(':')) & (chars[:, width - 3] == ord(':'))
+        & ((digits[:, digit_columns] >= 0) & (digits[:, digit_columns] <= 9)).all(axis=1)
+    )
+    invalid = np.nonzero(~empty & ~valid)[0]
+    if len(invalid) > 0:
+        raise ValueError("invalid time in stop_times: {!r}".format(values[invalid[0]]))
+    hours = digits[:, :width - 6] @ (10 ** np.arange(width - 7, -1, -1, dtype=np.int64))
+    seconds = hours * 3600 + (digits[:, width - 5] * 10 + digits[:, width - 4]) * 60 + digits[:, width - 2] * 10 + digits[:, width - 1]
+    seconds[empty] = -1
+    return seconds.astype(np.int32)
+
+# 文字列の列を table の番号の int32 配列にする intern=False なら table に無い値は -1
+def to_ids(table, values, intern=True):
+    uniques, inverse = np.unique(np.array(values, dtype=str), return_inverse=True)
+    if intern:
+        ids = [table.intern(value) for value in uniques.tolist()]
+    else:
+        ids = [table.lookup(value) for value in uniques.tolist()]
+        ids = [-1 if i is None else i for i in ids]
+    return np.array(ids, dtype=np.int32)[inverse.reshape(-1)]
+
+# trips.txt から trip ごとの路線と service の番号の配列を作る
+# service の番号は service_ids (service_matrix の列の順) に合わせ、calendar に無い service_id は -1
+def load_trips(source, service_ids):
+    trip_table = idset.InternTable()
+    route_table = idset.InternTable()
+    rows = read_table(source, 'trips')
+    header = next(rows)
+    rows = list(rows)
+    trip_ids = to_ids(trip_table, column(rows, header['trip_id']))
+    route_ids = to_ids(route_table, column(rows, header['route_id']))
+    service_index = {service_id: i for i, service_id in enumerate(service_ids)}
+    services = np.array([service_index.get(value, -1) for value in column(rows, header['service_id'])], dtype=np.int32)
+
+    trip_route = np.full(len(trip_table), -1, dtype=np.int32)
+    trip_service = np.full(len(trip_table), -1, dtype=np.int32)
+    trip_route[trip_ids] = route_ids
+    trip_service[trip_ids] = services
+    return {'trip_table': trip_table, 'route_table': route_table, 'route': trip_route, 'service': trip_service}
+
+# stop_times.txt を chunk_size 行ずつ列の配列にして返す
+# stop_id の番号付けは np.unique を使い時刻の変換より重いので、stop_table=None なら 'stop' の列は作らない
+def iter_stop_times(source, trip_table, stop_table=None, chunk_size=CHUNK_SIZE):
+    rows = read_table(source, 'stop_times')
+    header = next(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        columns = {
+            'trip': to_ids(trip_table, column(chunk, header['trip_id']), intern=False),
+            'departure': parse_times(column(chunk, header['departure_time']))
+        }
+        if stop_table is not None:
+            columns['stop'] = to_ids(stop_table, column(chunk, header['stop_id']))
+        yield columns
+
+# 1つのGTFSの 日付 x 路線 x 時 の発車数
+def count_departures(gtfs_path, chunk_size=CHUNK_SIZE):
+    with gtfsarchive.FeedSource(gtfs_path) as source:
+        service_matrix = load_service_matrix(source)
+        trips = load_trips(source, service_matrix['service_ids'])
+        n_services = len(service_matrix['service_ids'])
+        n_routes = len(trips['route_table'])
+        hours = 24
+        counts = np.zeros((n_services, n_routes, hours), dtype=np.int64)
+        for chunk in iter_stop_times(source, trips['trip_table'], chunk_size=chunk_size):
+            valid = (chunk['trip'] >= 0) & (chunk['departure'] >= 0)
+            trip = chunk['trip'][valid]
+            service = trips['service'][trip]
+            valid = service >= 0
+            service = service[valid]
+            route = trips['route'][trip][valid]
+            hour = chunk['departure'][valid] // 3600
+            if len(hour) > 0 and hour.max() >= hours:
+                counts = np.pad(counts, ((0, 0), (0, 0), (0, int(hour.max()) + 1 - hours)))
+                hours = counts.shape[2]
+            flat = (service.astype(np.int64) * n_routes + route) * hours + hour
+            counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape)
+
+    # 日付 x 路線 x 時 の配列は大きくなるので int32 にする (1つの値は1日・1路線・1時間の発車数)
+    departures = np.tensordot(service_matrix['matrix'].astype(np.int32), counts.astype(np.int32), axes=1)
+    return {
+        'name': gtfsarchive.feed_name(gtfs_path), 'start': service_matrix['start'], 'end': service_matrix['end'],
+        'route_ids': list(trips['route_table'].values), 'departures': departures
+    }
+
+# 2つの版の発車数を同じ形の配列に揃える 両方の版の期間に含まれる日付だけを比べる
+# 路線は両方の版の和集合、時は長い方に合わせる (片方にしか無い路線・時は 0 として比べる)
+def diff_departures(old, new):
+    start = max(old['start'], new['start'])
+    end = min(old['end'], new['end'])
+    old_routes = set(old['route_ids'])
+    route_ids = list(old['route_ids']) + [route_id for route_id in new['route_ids'] if route_id not in old_routes]
+    route_index = {route_id: i for i, route_id in enumerate(route_ids)}
+    hours = max(old['departures'].shape[2], new['departures'].shape[2])
+    n_days = max(0, (end - start).days + 1)
+
+    def aligned(frequency):
+        result = np.zeros((n_days, len(route_ids), hours), dtype=np.int32)
+        if n_days > 0:
+            offset = (start - frequency['start']).days
+            routes = np.array([route_index[route_id] for route_id in frequency['route_ids']], dtype=np.int64)
+            result[:, routes, :frequency['departures'].shape[2]] = frequency['departures'][offset:offset + n_days]
+        return result
+
+    return {
+        'old': old['name'], 'new': new['name'], 'start': start, 'route_ids': route_ids,
+        'old_departures': aligned(old), 'new_departures': aligned(new)
+    }
+
+# 発車数が変わった (日付, 路線, 時, 前の版の数, 新しい版の数) を日付順に返す
+def iter_changes(diff):
+    old = diff['old_departures']
+    new = diff['new_departures']
+    for day, route, hour in zip(*np.nonzero(old != new)):
+        yield (
+            diff['start'] + timedelta(days=int(day)), diff['route_ids'][route], int(hour),
+            int(old[day, route, hour]), int(new[day, route, hour])
+        )
+
+# gtfs_paths の順に隣り合う版の発車数を比べ、変化を CSV に書く
+def write_departure_diffs(gtfs_paths, path, chunk_size=CHUNK_SIZE):
+    count = 0
+    previous = None
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['old_gtfs', 'new_gtfs', 'date', 'route_id', 'hour', 'old_departures', 'new_departures'])
+        for gtfs_path in gtfs_paths:
+            frequency = count_departures(gtfs_path, chunk_size)
+            print("{}: {} routes, {} departures".format(frequency['name'], len(frequency['route_ids']), int(frequency['departures'].sum())))
+            if previous is not None:
+                diff = diff_departures(previous, frequency)
+                for change in iter_changes(diff):
+                    writer.writerow([diff['old'], diff['new']] + list(change))
+                    count += 1
+            previous = frequency
+    return count
+
+def main():
+    base_dir = "/Users/niya/Documents/oguchi/2020/gtfs/h2db/"
+    uncompress_dir = "uncompressed"
+    gtfs_paths = [files for files in Path(base_dir + uncompress_dir).iterdir() if gtfsarchive.is_feed(files)]
+    gtfs_paths.sort(key=gtfsarchive.feed_name)
+    write_departure_diffs(gtfs_paths, Path(base_dir + "departures_diff.csv"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+ベンチマーク用の合成データを作る 同じ引数(seed)からは常に同じファイルができる
+
+write_gtfs_feed:     service / trip / stop / stop_times の数と期間を指定して GTFS ディレクトリを作る
+                     version を変えると、同じ trip_id のうち change_ratio の割合が入れ替わった次の版になる
+write_alert_archive: GTFS-RT alert の .pb スナップショットを interval ごとに作る
+                     各スナップショットで alert の churn の割合が新しい alert に入れ替わる
+"""
+import csv
+import random
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from google.transit import gtfs_realtime_pb2
+
+
+WEEKDAY_PATTERNS = ["1111100", "0000011", "1111111", "0000010", "0000001"]
+
+def gtfs_date(d):
+    return d.strftime("%Y%m%d")
+
+# 秒を GTFS の HH:MM:SS にする 24時以降もそのまま (25:10:00 など)
+def gtfs_time(seconds):
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def write_rows(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def write_gtfs_feed(gtfs_dir, services=10, trips=1000, stops=200, stops_per_trip=20, routes=20,
+                    start_date=date(2020, 3, 1), days=60, exceptions=20, version=0, change_ratio=0.05, seed=0):
+    gtfs_dir = Path(gtfs_dir)
+    gtfs_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random("{}-{}".format(seed, version))
+    start_date = start_date + timedelta(days=version * 7) #版ごとに期間を1週間ずつずらす
+    end_date = start_date + timedelta(days=days - 1)
+
+    write_rows(gtfs_dir / "agency.txt", ["agency_id", "agency_name", "agency_url", "agency_timezone"],
+               [["A", "Synthetic", "http://example.com", "Asia/Tokyo"]])
+    write_rows(gtfs_dir / "feed_info.txt", ["feed_publisher_name", "feed_publisher_url", "feed_lang", "feed_start_date", "feed_end_date"],
+               [["synthetic", "http://example.com", "ja", gtfs_date(start_date), gtfs_date(end_date)]])
+    write_rows(gtfs_dir / "routes.txt", ["route_id", "agency_id", "route_short_name", "route_type"],
+               [["R{}".format(i), "A", str(i), 3] for i in range(routes)])
+    write_rows(gtfs_dir / "stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon"],
+               [["P{}".format(i), "stop {}".format(i), 35 + i * 1e-4, 139 + i * 1e-4] for i in range(stops)])
+    write_rows(gtfs_dir / "shapes.txt", ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"], [])
+
+    service_ids = ["S{}".format(i) for i in range(services)]
+    write_rows(gtfs_dir / "calendar.txt",
+               ["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "start_date", "end_date"],
+               [[service_id] + list(WEEKDAY_PATTERNS[i % len(WEEKDAY_PATTERNS)]) + [gtfs_date(start_date), gtfs_date(end_date)]
+                for i, service_id in enumerate(service_ids)])
+    write_rows(gtfs_dir / "calendar_dates.txt", ["service_id", "date", "exception_type"],
+               [[rng.choice(service_ids), gtfs_date(start_date + timedelta(days=rng.randrange(days))), rng.choice([1, 2])]
+                for _ in range(exceptions)])
+
+    # trip_id は版をまたいで共通 change_ratio の割合だけ版ごとの新しい trip_id にする
+    trip_rows = []
+    for i in range(trips):
+        trip_id = "V{}T{}".format(version, i) if version > 0 and rng.random() < change_ratio else "T{}".format(i)
+        trip_rows.append([trip_id, "R{}".format(i % routes), service_ids[i % services]])
+    write_rows(gtfs_dir / "trips.txt", ["trip_id", "route_id", "service_id"], trip_rows)
+
+    # stop_times は件数が多いので csv.writer を通さずに書く
+    with open(gtfs_dir / "stop_times.txt", 'w') as f:
+        f.write("trip_id,arrival_time,departure_time,stop_id,stop_sequence\n")
+        for trip_id, _, _ in trip_rows:
+            t = rng.randrange(5 * 3600, 25 * 3600, 60) #始発 5:00 から 24時過ぎまで
+            first_stop = rng.randrange(stops)
+            for sequence in range(stops_per_trip):
+                time_string = gtfs_time(t)
+                f.write("{},{},{},P{},{}\n".format(trip_id, time_string, time_string, (first_stop + sequence) % stops, sequence + 1))
+                t += rng.randrange(60, 300, 30)
+
+    write_rows(gtfs_dir / "translations.txt", ["table_name", "field_name", "language", "translation", "record_id"], [])
+    return {'path': gtfs_dir, 'start': start_date, 'end': end_date, 'trip_ids': [row[0] for row in trip_rows],
+            'route_ids': ["R{}".format(i) for i in range(routes)], 'stop_times': trips * stops_per_trip}
+
+def make_alert(rng, number, start_time, trip_ids, route_ids, no_service_ratio):
+    start = int(start_time.timestamp()) + rng.randrange(-3, 10) * 86400
+    effect = 'NO_SERVICE' if rng.random() < no_service_ratio else rng.choice(['REDUCED_SERVICE', 'DETOUR', 'MODIFIED_SERVICE'])
+    return {
+        'id': "alert{}".format(number), 'start': start, 'end': start + rng.randrange(1, 20) * 86400,
+        'effect': gtfs_realtime_pb2.Alert.Effect.Value(effect), 'cause': gtfs_realtime_pb2.Alert.Cause.Value('OTHER_CAUSE'),
+        'trip_ids': rng.sample(trip_ids, min(len(trip_ids), rng.randrange(1, 10))), 'route_id': rng.choice(route_ids)
+    }
+
+def write_alert_archive(alert_dir, trip_ids, route_ids, start_time=datetime(2020, 3, 1, 3, 0, 7), snapshots=100,
+                        interval=timedelta(hours=1), alerts=50, churn=0.02, no_service_ratio=0.5, seed=0):
+    alert_dir = Path(alert_dir)
+    alert_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    number = 0
+    active = []
+    for _ in range(alerts):
+        active.append(make_alert(rng, number, start_time, trip_ids, route_ids, no_service_ratio))
+        number += 1
+
+    t = start_time
+    for _ in range(snapshots):
+        for i in range(len(active)):
+            if rng.random() < churn:
+                active[i] = make_alert(rng, number, t, trip_ids, route_ids, no_service_ratio)
+                number += 1
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "2.0"
+        feed.header.timestamp = int(t.timestamp())
+        for a in active:
+            entity = feed.entity.add()
+            entity.id = a['id']
+            period = entity.alert.active_period.add()
+            period.start = a['start']
+            period.end = a['end']
+            entity.alert.informed_entity.add().route_id = a['route_id']
+            for trip_id in a['trip_ids']:
+                entity.alert.informed_entity.add().trip.trip_id = trip_id
+            entity.alert.cause = a['cause']
+            entity.alert.effect = a['effect']
+            entity.alert.url.translation.add(text="http://example.com/{}".format(a['id']), language="ja")
+            entity.alert.header_text.translation.add(text="header {}".format(a['id']), language="ja")
+            entity.alert.description_text.translation.add(text="description {}".format(a['id']), language="ja")
+        with open(alert_dir / (t.strftime("%Y-%m-%dT%H:%M:%S") + "+09:00.pb"), 'wb') as f:
+            f.write(feed.SerializeToString())
+        t = t + interval
+    return {'path': alert_dir, 'start': start_time, 'end': t - interval, 'snapshots': snapshots}